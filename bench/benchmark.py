@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Nik4 benchmark: renders synthetic local data with a matrix of options.
+# Licensed WTFPL, like Nik4 itself.
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nik4  # noqa: E402
+
+
+# Synthetic data covers this lon/lat box
+EXTENT = (24.6, 59.35, 24.9, 59.5)
+SIZES = ['800x600', '2000x2000']
+TILES = [1, 4]
+FACTORS = [1, 2]
+FORMATS = ['png256', 'png', 'jpeg', 'svg', 'pdf']
+SHP_POLYLINE = 3
+SHP_POLYGON = 5
+
+STYLE = '''<?xml version="1.0" encoding="utf-8"?>
+<Map srs="+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs +over" background-color="#f2efe9">
+  <Style name="polygons">
+    <Rule>
+      <PolygonSymbolizer fill="#c8d7ab" fill-opacity="0.7"/>
+      <LineSymbolizer stroke="#8a9a6b" stroke-width="0.5"/>
+    </Rule>
+  </Style>
+  <Style name="lines">
+    <Rule>
+      <LineSymbolizer stroke="#ffffff" stroke-width="4" stroke-linecap="round"/>
+      <LineSymbolizer stroke="#e89a3c" stroke-width="2.5" stroke-linecap="round"/>
+    </Rule>
+  </Style>
+  <Style name="points">
+    <Rule>
+      <MarkersSymbolizer width="6" fill="#3c6ee8" stroke="#ffffff" stroke-width="1"
+          allow-overlap="true"/>
+    </Rule>
+  </Style>
+  <Layer name="polygons" srs="+proj=longlat +datum=WGS84 +no_defs">
+    <StyleName>polygons</StyleName>
+    <Datasource>
+      <Parameter name="type">shape</Parameter>
+      <Parameter name="file">polygons.shp</Parameter>
+    </Datasource>
+  </Layer>
+  <Layer name="lines" srs="+proj=longlat +datum=WGS84 +no_defs">
+    <StyleName>lines</StyleName>
+    <Datasource>
+      <Parameter name="type">shape</Parameter>
+      <Parameter name="file">lines.shp</Parameter>
+    </Datasource>
+  </Layer>
+  <Layer name="points_csv" srs="+proj=longlat +datum=WGS84 +no_defs">
+    <StyleName>points</StyleName>
+    <Datasource>
+      <Parameter name="type">csv</Parameter>
+      <Parameter name="file">points.csv</Parameter>
+    </Datasource>
+  </Layer>
+  <Layer name="points_geojson" srs="+proj=longlat +datum=WGS84 +no_defs">
+    <StyleName>points</StyleName>
+    <Datasource>
+      <Parameter name="type">geojson</Parameter>
+      <Parameter name="file">points.geojson</Parameter>
+    </Datasource>
+  </Layer>
+</Map>
+'''
+
+
+def random_point(rnd):
+    return (rnd.uniform(EXTENT[0], EXTENT[2]), rnd.uniform(EXTENT[1], EXTENT[3]))
+
+
+def random_line(rnd, vertices):
+    x, y = random_point(rnd)
+    step = (EXTENT[2] - EXTENT[0]) / 200
+    angle = rnd.uniform(0, 2 * math.pi)
+    points = [(x, y)]
+    for _ in range(vertices - 1):
+        angle += rnd.uniform(-0.5, 0.5)
+        x += step * math.cos(angle)
+        y += step * math.sin(angle) / 2
+        points.append((x, y))
+    return points
+
+
+def random_polygon(rnd, vertices):
+    cx, cy = random_point(rnd)
+    radius = (EXTENT[2] - EXTENT[0]) / 100
+    points = []
+    for i in range(vertices):
+        # shapefile outer rings are clockwise
+        angle = -2 * math.pi * i / vertices
+        r = radius * rnd.uniform(0.5, 1.0)
+        points.append((cx + r * math.cos(angle), cy + r * math.sin(angle) / 2))
+    points.append(points[0])
+    return points
+
+
+def write_shapefile(path, shape_type, shapes):
+    """Write a list of single-part shapes with .shp, .shx, .dbf and .prj files"""
+    def header(length, bbox):
+        return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, length // 2) +
+                struct.pack('<2i4d4d', 1000, shape_type, *(bbox + (0, 0, 0, 0))))
+
+    records = []
+    for points in shapes:
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        content = struct.pack('<i4d2i', shape_type, min(xs), min(ys), max(xs), max(ys),
+                              1, len(points))
+        content += struct.pack('<i', 0)
+        content += b''.join(struct.pack('<2d', *p) for p in points)
+        records.append(content)
+
+    all_x = [p[0] for s in shapes for p in s]
+    all_y = [p[1] for s in shapes for p in s]
+    bbox = (min(all_x), min(all_y), max(all_x), max(all_y))
+    shp_length = 100 + sum(8 + len(r) for r in records)
+    with open(path + '.shp', 'wb') as shp, open(path + '.shx', 'wb') as shx:
+        shp.write(header(shp_length, bbox))
+        shx.write(header(100 + 8 * len(records), bbox))
+        offset = 100
+        for i, content in enumerate(records):
+            shp.write(struct.pack('>2i', i + 1, len(content) // 2))
+            shp.write(content)
+            shx.write(struct.pack('>2i', offset // 2, len(content) // 2))
+            offset += 8 + len(content)
+
+    with open(path + '.dbf', 'wb') as dbf:
+        dbf.write(struct.pack('<B3BIHH20x', 3, 126, 1, 1, len(records), 65, 11))
+        dbf.write(struct.pack('<11sc4xBB14x', b'id', b'N', 10, 0))
+        dbf.write(b'\r')
+        for i in range(len(records)):
+            dbf.write(b' ' + '{:>10d}'.format(i).encode('ascii'))
+        dbf.write(b'\x1a')
+
+    with open(path + '.prj', 'w') as prj:
+        prj.write('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+                  'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]')
+
+
+def generate(path, density, seed=1):
+    """Create synthetic datasets and a style for them in a directory.
+
+    density is the number of features in each dataset; vertex counts of
+    lines and polygons are fixed, so output is the same for the same seed.
+    Returns the style path.
+    """
+    rnd = random.Random(seed)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'points.csv'), 'w') as f:
+        f.write('x,y,id\n')
+        for i in range(density):
+            f.write('{:.6f},{:.6f},{}\n'.format(*(random_point(rnd) + (i,))))
+    features = [{'type': 'Feature', 'properties': {'id': i},
+                 'geometry': {'type': 'Point', 'coordinates': random_point(rnd)}}
+                for i in range(density)]
+    with open(os.path.join(path, 'points.geojson'), 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    write_shapefile(os.path.join(path, 'lines'), SHP_POLYLINE,
+                    [random_line(rnd, 20) for _ in range(density)])
+    write_shapefile(os.path.join(path, 'polygons'), SHP_POLYGON,
+                    [random_polygon(rnd, 12) for _ in range(density)])
+    style = os.path.join(path, 'style.xml')
+    with open(style, 'w') as f:
+        f.write(STYLE)
+    return style
+
+
+def case_name(size, tiles, factor, fmt):
+    return '{}_t{}_f{:g}_{}'.format(size, tiles, factor, fmt)
+
+
+def time_case(style, out_dir, size, tiles, factor, fmt, repeat):
+    """Render one case repeat times, return the best time in seconds"""
+    ext = 'png' if fmt.startswith('png') else fmt
+    output = os.path.join(out_dir, case_name(size, tiles, factor, fmt) + '.' + ext)
+    args = ['-b'] + [str(c) for c in EXTENT] + ['-x'] + size.split('x') + [
+        '--factor', str(factor), '-t', str(tiles), '-f', fmt, style, output]
+    options = nik4.create_parser().parse_args(args)
+    nik4.parse_tiles(options)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        nik4.run(options)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def compare(results, baseline, threshold):
+    """Print changes against baseline results, return names of regressed cases"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print('{:<32} {:>9.1f} ms  (new)'.format(name, results[name] * 1000))
+            continue
+        change = results[name] / baseline[name] - 1 if baseline[name] else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{:<32} {:>9.1f} ms  {:>+6.1f}%{}'.format(
+            name, results[name] * 1000, change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Nik4 on synthetic data without a database or network')
+    parser.add_argument('--data', help='Directory for generated data (default: temporary)')
+    parser.add_argument('--density', type=int, default=2000,
+                        help='Number of features in each dataset (default=2000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for data')
+    parser.add_argument('--sizes', default=','.join(SIZES), help='Output sizes in pixels')
+    parser.add_argument('--tiles', default=','.join(str(t) for t in TILES),
+                        help='Tile counts for --tiles')
+    parser.add_argument('--factors', default=','.join(str(f) for f in FACTORS),
+                        help='Values for --factor')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='Output formats')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Render each case N times and take the best time (default=3)')
+    parser.add_argument('--save', metavar='FILE', help='Store results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare results with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown flagged as a regression (default=0.1)')
+    options = parser.parse_args()
+
+    data_dir = options.data or tempfile.mkdtemp(prefix='nik4-bench-')
+    style = generate(data_dir, options.density, options.seed)
+    out_dir = os.path.join(data_dir, 'out')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    results = {}
+    matrix = itertools.product(
+        options.sizes.split(','), [int(t) for t in options.tiles.split(',')],
+        [float(f) for f in options.factors.split(',')], options.formats.split(','))
+    for size, tiles, factor, fmt in matrix:
+        name = case_name(size, tiles, factor, fmt)
+        results[name] = time_case(style, out_dir, size, tiles, factor, fmt, options.repeat)
+        print('{:<32} {:>9.1f} ms'.format(name, results[name] * 1000))
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with {}:'.format(options.baseline))
+        regressions = compare(results, baseline, options.threshold)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'version': nik4.VERSION, 'density': options.density,
+                       'repeat': options.repeat, 'results': results}, f, indent=2, sort_keys=True)
+    if regressions:
+        print('{} cases are slower by more than {:.0%}'.format(
+            len(regressions), options.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Nik4 startup benchmark: time of command line paths that do not render.
+# Licensed WTFPL, like Nik4 itself.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+NIK4 = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nik4.py')
+CASES = [
+    ('help', [NIK4, '--help']),
+    ('version', [NIK4, '--version']),
+    ('argument error', [NIK4]),
+    ('import', ['-c', 'import sys; sys.path.insert(0, {!r}); import nik4; '
+                'sys.exit("mapnik" in sys.modules)'.format(os.path.dirname(NIK4))]),
+]
+
+
+def time_command(args, repeat):
+    """Run python with args repeat times, return the median time and last exit code"""
+    times = []
+    code = None
+    for _ in range(repeat):
+        start = time.time()
+        code = subprocess.call([sys.executable] + args,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2], code
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that Nik4 starts quickly when it does not need to render')
+    parser.add_argument('--repeat', type=int, default=11,
+                        help='Run each case N times and take the median (default=11)')
+    parser.add_argument('--budget', type=float, default=0.25,
+                        help='Maximum time for each case in seconds (default=0.25)')
+    options = parser.parse_args()
+
+    start = time.time()
+    subprocess.call([sys.executable, '-c', 'pass'])
+    print('{:<20} {:>9.1f} ms'.format('python', (time.time() - start) * 1000))
+
+    failed = []
+    for name, args in CASES:
+        seconds, code = time_command(args, options.repeat)
+        flag = ''
+        if seconds > options.budget:
+            flag = '  OVER BUDGET'
+            failed.append(name)
+        elif name == 'import' and code:
+            flag = '  MAPNIK IMPORTED'
+            failed.append(name)
+        print('{:<20} {:>9.1f} ms{}'.format(name, seconds * 1000, flag))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
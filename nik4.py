@@ -5,41 +5,99 @@
 # Run it with -h to see the list of options
 # Written by Ilya Zverev, licensed WTFPL
 
-import mapnik
 import sys
 import os
 import re
 import argparse
 import math
 import tempfile
+import shutil
+import struct
+import zlib
 import logging
 import codecs
+import collections
+import io
+import copy
+import functools
+import importlib
+import hashlib
+import json
+import time
+import multiprocessing
+
+
+class LazyModule(object):
+    """Module that is imported on first access to its attributes.
+
+    mapnik and cairo take a noticeable time to load, which is not needed
+    for --help or for importing nik4 without rendering anything.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._error = None
+
+    def load(self):
+        """Import the module, return it or None when it is not installed"""
+        if self._module is None and self._error is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError as e:
+                self._error = e
+        return self._module
+
+    def __getattr__(self, attr):
+        if self.load() is None:
+            raise self._error
+        return getattr(self._module, attr)
+
 
-try:
-    import cairo
-    HAS_CAIRO = True
-except ImportError:
-    HAS_CAIRO = False
+mapnik = LazyModule('mapnik')
+cairo = LazyModule('cairo')
 
 VERSION = '1.8'
 TILE_BUFFER = 128
-IM_MONTAGE = 'montage'
+# lossless and fast format for passing tiles between processes
+TILE_TRANSFER_FORMAT = 'png32:z=1'
+STREAM_CHUNK = 1024 * 1024
+# threads saving tiles while the next ones render, and tiles waiting for them
+WRITE_THREADS = 2
+WRITE_QUEUE = 4
+# maps loaded with different variables, layers or projections, kept for reuse
+MAP_CACHE_SIZE = 8
+# files of --shard in the output directory, see run_shard()
+SHARD_TILE = '{:02d}_{:02d}.png'
+SHARD_MANIFEST = 'shard-{}-of-{}.json'
+SHARD_SCHEMA = 1
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# --palette auto quantizes PALETTE_WINDOWS×PALETTE_WINDOWS windows of PALETTE_CELL pixels
+PALETTE_WINDOWS = 3
+PALETTE_CELL = 256
+GEOTIFF_FORMATS = ['tif', 'cog']
+GEOTIFF_TILE = 512
+WATCH_TILE = 512
+# extra bytes per pixel that encoders need for a copy of the image
+ENCODE_BYTES = {'png256': 2, 'png8': 2, 'png': 2, 'png32': 4, 'jpeg': 3, 'webp': 4,
+                'tif': 0, 'cog': 0}
+TIFF_TYPES = {3: 'H', 4: 'I', 12: 'd', 16: 'Q'}
+MERC_MAX = 20037508.342789244
+EARTH_RADIUS = 6378137.0
+PROFILE_SCHEMA = 1
+ENVELOPE_CACHE = 'envelopes.json'
 EPSG_4326 = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs'
 EPSG_3857 = ('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 ' +
              '+k=1.0 +units=m +nadgrids=@null +no_defs +over')
 
-proj_lonlat = mapnik.Projection(EPSG_4326)
-proj_web_merc = mapnik.Projection(EPSG_3857)
-transform_lonlat_webmerc = mapnik.ProjTransform(proj_lonlat, proj_web_merc)
 
-
-def layer_bbox(m, names, proj_target, bbox=None):
+def layer_bbox(m, names, proj_target, bbox=None, cache_dir=None):
     """Calculate extent of given layers and bbox"""
     for layer in (l for l in m.layers if l.name in names):
         # it may as well be a GPX layer in WGS84
         layer_proj = mapnik.Projection(layer.srs)
         box_trans = mapnik.ProjTransform(layer_proj, proj_target)
-        lbbox = box_trans.forward(layer.envelope())
+        lbbox = box_trans.forward(layer_envelope(layer, cache_dir))
         if bbox:
             bbox.expand_to_include(lbbox)
         else:
@@ -177,7 +235,7 @@ def parse_url(url, options):
         m = re.search(r'zoom=([0-9]{1,2})', url, flags=re.IGNORECASE)
         if m:
             zoom = int(m.group(1))
-    if zoom and not options.zoom:
+    if zoom is not None and options.zoom is None:
         options.zoom = zoom
     if lat and lon and not options.center:
         options.center = [lon, lat]
@@ -215,48 +273,99 @@ def get_paper_size(name):
     return None
 
 
-def xml_vars(style, variables):
-    """Replace ${name:default} from style with variables[name] or 'default'"""
-    # Convert variables to a dict
+STYLE_VARIABLE = r'\$\{([a-z0-9_]+)(?::([^}]*))?\}'
+STYLE_TOKENS = re.compile(r'<!--.*?-->|<Layer\b[^>]*>|</Layer\s*>|' + STYLE_VARIABLE, re.DOTALL)
+LAYER_NAME = re.compile(r'\bname\s*=\s*(["\'])(.*?)\1', re.DOTALL)
+LAYER_STATUS_OFF = re.compile(r'\s+status\s*=\s*(["\'])off\1')
+
+
+def parse_vars(variables):
+    """Convert a list of name=value strings to a dict with XML-escaped values"""
     v = {}
-    for kv in variables:
+    for kv in variables or []:
         keyvalue = kv.split('=', 1)
         if len(keyvalue) > 1:
             v[keyvalue[0]] = keyvalue[1].replace('&', '&amp;').replace(
                 '<', '&lt;').replace('>', '&gt;').replace(
                 '"', '&quot;').replace("'", '&#39;')
-    if not v:
-        return style
-    # Scan all variables in style
-    r = re.compile(r'\$\{([a-z0-9_]+)(?::([^}]*))?\}')
-    rstyle = ''
+    return v
+
+
+def preprocess_style(style, variables=None, enable=None, keep=None):
+    """Prepare style XML for loading, in a single pass.
+
+    When variables are given, replaces ${name:default} with variables[name]
+    or 'default', in comments too, like it was done for the whole file.
+    Removes status="off" from layers named in enable list. When keep is
+    given, top-level layers for which keep(name) is false are removed from
+    the style, so mapnik does not create their datasources; required
+    variables in them are still checked.
+    """
+    v = parse_vars(variables)
+    enable = set(enable or [])
+
+    def var_value(match):
+        if match.group(1) in v:
+            return v[match.group(1)]
+        elif match.group(2) is not None:
+            return match.group(2)
+        raise Exception('Found required style parameter: ' + match.group(1))
+
+    parts = []
     last = 0
-    for m in r.finditer(style):
-        if m.group(1) in v:
-            value = v[m.group(1)]
-        elif m.group(2) is not None:
-            value = m.group(2)
+    depth = 0
+    skip_depth = None
+    for match in STYLE_TOKENS.finditer(style):
+        token = match.group(0)
+        is_open = token.startswith('<Layer')
+        is_close = token.startswith('</')
+        if skip_depth is None:
+            parts.append(style[last:match.start()])
+        last = match.end()
+        if is_open and not token.endswith('/>'):
+            depth += 1
+        elif is_close:
+            depth -= 1
+        if v and not is_close:
+            # a variable, or a comment or a Layer tag that can contain them
+            token = re.sub(STYLE_VARIABLE, var_value, token)
+        if skip_depth is not None:
+            if depth < skip_depth:
+                skip_depth = None
+            continue
+
+        if is_open:
+            name = LAYER_NAME.search(token)
+            name = name.group(2) if name else ''
+            # nested layers go with their parent, like in filter_layers()
+            top_level = depth == (0 if token.endswith('/>') else 1)
+            if keep is not None and top_level and not keep(name):
+                if not token.endswith('/>'):
+                    skip_depth = depth
+                continue
+            if name in enable:
+                token = LAYER_STATUS_OFF.sub('', token)
+            parts.append(token)
         else:
-            raise Exception('Found required style parameter: ' + m.group(1))
-        rstyle = rstyle + style[last:m.start()] + value
-        last = m.end()
-    if last < len(style):
-        rstyle = rstyle + style[last:]
-    return rstyle
-
-
-def reenable_layers(style, layers):
-    """Remove status=off from layers we need."""
-    layer_select = '|'.join([l.replace('\\', '\\\\').replace('|', '\\|')
-                             .replace('.', '\\.').replace('+', '\\+')
-                             .replace('*', '\\*') for l in layers])
-    style = re.sub(
-        r'(<Layer[^>]+name=["\'](?:{})["\'][^>]+)status=["\']off["\']'.format(layer_select),
-        r'\1', style, flags=re.DOTALL)
-    style = re.sub(
-        r'(<Layer[^>]+)status=["\']off["\']([^>]+name=["\'](?:{})["\'])'.format(layer_select),
-        r'\1\2', style, flags=re.DOTALL)
-    return style
+            parts.append(token)
+    if skip_depth is None:
+        parts.append(style[last:])
+    return ''.join(parts)
+
+
+def layer_keeper(layers, add_layers, hide_layers, fit_layers):
+    """Make keep(name) for preprocess_style(), or None when all layers are needed"""
+    if not layers and not hide_layers:
+        return None
+
+    def keep(name):
+        # layers for --fit are needed for their extent even when not rendered
+        if name in fit_layers:
+            return True
+        if name in hide_layers:
+            return False
+        return not layers or name in layers or name in add_layers
+    return keep
 
 
 def parse_layers_string(layers):
@@ -279,42 +388,1215 @@ def correct_scale(bbox, scale, bbox_web_merc, bbox_target):
     return scale * (x_dist_target / x_dist_merc)
 
 
-def run(options):
+class Profiler(object):
+    """Collect wall and CPU time and memory of run() phases and tiles.
+
+    lap(name) ends a phase started at the previous lap. Saved with
+    save() as JSON of PROFILE_SCHEMA version.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.tiles = {}
+        self.info = {}
+        self.start = self.last = (time.time(), time.process_time())
+
+    def lap(self, name):
+        now = (time.time(), time.process_time())
+        self.phases.append({
+            'name': name,
+            'wall': now[0] - self.last[0],
+            'cpu': now[1] - self.last[1],
+            'peak_rss_kb': peak_rss_kb(),
+        })
+        self.last = now
+
+    def tile(self, key, **seconds):
+        """Add seconds spent on a tile, key is (level, row, column)"""
+        timing = self.tiles.setdefault(key, {})
+        for name, value in seconds.items():
+            timing[name] = timing.get(name, 0) + value
+
+    def save(self, path):
+        now = (time.time(), time.process_time())
+        result = {'schema': PROFILE_SCHEMA, 'version': VERSION}
+        result.update(self.info)
+        result.update({
+            'total': {
+                'wall': now[0] - self.start[0],
+                'cpu': now[1] - self.start[1],
+                'peak_rss_kb': peak_rss_kb(),
+                'children_cpu': children_cpu(),
+                'children_peak_rss_kb': peak_rss_kb(children=True),
+            },
+            'phases': self.phases,
+            'tiles': [dict([('level', k[0]), ('row', k[1]), ('column', k[2])] +
+                           sorted(v.items())) for k, v in sorted(self.tiles.items())],
+        })
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def peak_rss_kb(children=False):
+    """Peak resident memory size of this process or its finished children, in kilobytes"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # macOS reports bytes, Linux reports kilobytes
+    return rss.ru_maxrss // 1024 if sys.platform == 'darwin' else rss.ru_maxrss
+
+
+def children_cpu():
+    """CPU time used by finished child processes"""
+    times = os.times()
+    return times[2] + times[3]
+
+
+def has_cairo():
+    """Check if pycairo is installed, for scaling svg and pdf"""
+    return cairo.load() is not None
+
+
+@functools.lru_cache(maxsize=None)
+def get_projection(projection):
+    """Make mapnik.Projection from an EPSG code or a Proj4 string"""
+    if projection.isdigit():
+        return mapnik.Projection('+init=epsg:{}'.format(projection))
+    return mapnik.Projection(projection)
+
+
+@functools.lru_cache(maxsize=None)
+def lonlat_webmerc():
+    """Transform from WGS84 to Web Mercator"""
+    return mapnik.ProjTransform(get_projection(EPSG_4326), get_projection(EPSG_3857))
+
+
+def __getattr__(name):
+    """Module-level names of nik4 1.8, now made on first access"""
+    if name == 'HAS_CAIRO':
+        return has_cairo()
+    if name == 'proj_lonlat':
+        return get_projection(EPSG_4326)
+    if name == 'proj_web_merc':
+        return get_projection(EPSG_3857)
+    if name == 'transform_lonlat_webmerc':
+        return lonlat_webmerc()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def is_web_mercator(projection):
+    """Check if a --projection value is EPSG:3857, which ozi files need"""
+    return projection.lower() == 'epsg:3857' or projection == EPSG_3857
+
+
+def box_tuple(box):
+    """Convert mapnik.Box2d to a picklable tuple"""
+    return (box.minx, box.miny, box.maxx, box.maxy)
+
+
+def image_to_string(im, fmt=None, palette=None):
+    """Encode image to bytes, or return raw pixels when fmt is None.
+
+    palette is RGBA bytes for PNG formats, see make_palette().
+    """
+    # mapnik 4 bindings renamed tostring to to_string
+    encode = im.to_string if hasattr(im, 'to_string') else im.tostring
+    if palette:
+        return encode(fmt, make_palette(palette))
+    return encode(fmt) if fmt else encode()
+
+
+def image_from_string(data):
+    """Decode image from encoded bytes"""
+    if hasattr(mapnik.Image, 'from_buffer'):
+        return mapnik.Image.from_buffer(data)
+    return mapnik.Image.frombuffer(data)
+
+
+def save_image(im, outfile, fmt, palette=None):
+    """Save image to a file name or encode it into a file object"""
+    if hasattr(outfile, 'write'):
+        outfile.write(image_to_string(im, fmt, palette))
+    elif palette:
+        im.save(outfile, fmt, make_palette(palette))
+    else:
+        im.save(outfile, fmt)
+
+
+def png_palette(data):
+    """Read colors of a paletted PNG as RGBA bytes, or return None for other images"""
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+    pos = len(PNG_SIGNATURE)
+    plte = trns = None
+    while pos + 8 <= len(data):
+        length, tag = struct.unpack('>I4s', data[pos:pos + 8])
+        if tag == b'PLTE':
+            plte = data[pos + 8:pos + 8 + length]
+        elif tag == b'tRNS':
+            trns = data[pos + 8:pos + 8 + length]
+        elif tag == b'IDAT':
+            break
+        pos += 12 + length
+    if not plte:
+        return None
+    trns = trns or b''
+    return b''.join(plte[i * 3:i * 3 + 3] + (trns[i:i + 1] or b'\xff')
+                    for i in range(len(plte) // 3))
+
+
+def load_palette(path):
+    """Read a palette from a paletted PNG, an .act or a raw RGB file, return RGBA bytes"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(PNG_SIGNATURE):
+        colors = png_palette(data)
+        if not colors:
+            raise Exception('{} has no palette, save it as png256'.format(path))
+        return colors
+    transparent = -1
+    if len(data) == 772:
+        # Adobe color table: 256 colors, then their count and a transparent index
+        count, transparent = struct.unpack('>Hh', data[768:])
+        data = data[:3 * (count or 256)]
+    if not data or len(data) % 3 or len(data) > 768:
+        raise Exception('{} is not a paletted PNG, an .act or an RGB palette'.format(path))
+    return b''.join(data[i * 3:i * 3 + 3] + (b'\0' if i == transparent else b'\xff')
+                    for i in range(len(data) // 3))
+
+
+@functools.lru_cache()
+def make_palette(colors):
+    """Make mapnik.Palette from RGBA bytes, created once for each palette"""
+    try:
+        return mapnik.Palette(colors, 'rgba')
+    except RuntimeError:
+        # mapnik 4 bindings take only rgb palettes
+        if colors[3::4].strip(b'\xff'):
+            logging.warning('Transparent colors of the palette are made opaque')
+        return mapnik.Palette(b''.join(colors[i:i + 3] for i in range(0, len(colors), 4)),
+                              'rgb')
+
+
+def uses_palette(fmt):
+    """Check if a format is encoded with a palette given to --palette"""
+    return fmt.startswith('png')
+
+
+def palette_windows(bbox, size, count=PALETTE_WINDOWS):
+    """Spread count×count windows of PALETTE_CELL pixels over a map of size showing bbox"""
+    dx = (bbox.maxx - bbox.minx) / size[0] * PALETTE_CELL
+    dy = (bbox.maxy - bbox.miny) / size[1] * PALETTE_CELL
+    windows = []
+    for row in range(count):
+        for column in range(count):
+            x = bbox.minx + (bbox.maxx - bbox.minx - dx) * (column + 0.5) / count
+            y = bbox.miny + (bbox.maxy - bbox.miny - dy) * (row + 0.5) / count
+            windows.append(mapnik.Box2d(x, y, x + dx, y + dy))
+    return windows
+
+
+def sample_palette(views, fmt):
+    """Quantize windows from palette_windows() rendered at their full resolution.
+
+    views is a list of (map, window, scale_factor). The windows are joined
+    into one image, which is encoded in fmt if it is a paletted PNG format,
+    and in png256 otherwise. Returns RGBA bytes. The maps are resized, so
+    they should be zoomed again after this.
+    """
+    cell = PALETTE_CELL
+    im = mapnik.Image(cell * len(views), cell)
+    for i, (m, window, scale_factor) in enumerate(views):
+        m.resize(cell, cell)
+        m.zoom_to_box(window)
+        part = mapnik.Image(cell, cell)
+        mapnik.render(m, part, scale_factor)
+        im.composite(part, mapnik.CompositeOp.src, 1.0, i * cell, 0)
+    sample_fmt = fmt if fmt.split(':')[0] in ('png8', 'png256') else 'png256'
+    return png_palette(image_to_string(im, sample_fmt))
+
+
+def palette_colors(palette, m, windows, scale_factor, fmt):
+    """Get colors for --palette: 'auto', a file name, or RGBA bytes"""
+    if isinstance(palette, bytes):
+        return palette
+    if palette == 'auto':
+        colors = sample_palette([(m, window, scale_factor) for window in windows], fmt)
+        logging.info('Sampled a palette of %s colors', len(colors) // 4)
+        return colors
+    return load_palette(palette)
+
+
+def png_chunk(tag, data):
+    """Make a PNG chunk with length and checksum"""
+    return b''.join([struct.pack('>I', len(data)), tag, data,
+                     struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)])
+
+
+class PNGStripWriter(object):
+    """Join tiles into a 32-bit PNG file, writing it row by row.
+
+    Tiles can be added in any order, but only tiles of unfinished rows
+    are kept in memory. outfile is a file name or a file object.
+    """
+
+    def __init__(self, outfile, width, height, columns, level=6):
+        if hasattr(outfile, 'write'):
+            self.f = outfile
+            self.own_file = False
+        else:
+            self.f = open(outfile, 'wb')
+            self.own_file = True
+        self.width = width
+        self.columns = columns
+        self.rows = {}
+        self.next_row = 0
+        self.compressor = zlib.compressobj(level)
+        self.buf = []
+        self.buf_size = 0
+        self.f.write(PNG_SIGNATURE)
+        # 8 bits per sample, RGBA, no interlacing
+        self.f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+
+    def add_tile(self, row, column, im):
+        self.rows.setdefault(row, {})[column] = im
+        while len(self.rows.get(self.next_row, {})) == self.columns:
+            self.write_row(self.rows.pop(self.next_row))
+            self.next_row += 1
+
+    def write_row(self, tiles):
+        tiles = [tiles[c] for c in range(self.columns)]
+        data = [image_to_string(im) for im in tiles]
+        stride = [im.width() * 4 for im in tiles]
+        for y in range(tiles[0].height()):
+            line = b''.join([d[y * st:(y + 1) * st] for d, st in zip(data, stride)])
+            # every scanline starts with filter type 0 (none)
+            self.write_data(b'\0')
+            self.write_data(line)
+
+    def write_data(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.buf.append(data)
+            self.buf_size += len(data)
+            if self.buf_size >= STREAM_CHUNK:
+                self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.f.write(png_chunk(b'IDAT', b''.join(self.buf)))
+            self.buf = []
+            self.buf_size = 0
+
+    def close(self):
+        if self.rows:
+            raise Exception('Missing tiles in rows {}'.format(sorted(self.rows)))
+        self.buf.append(self.compressor.flush())
+        self.flush()
+        self.f.write(png_chunk(b'IEND', b''))
+        if self.own_file:
+            self.f.close()
+
+
+class TileJoiner(object):
+    """Join tiles into one image, keeping their pixels exactly.
+
+    Compositing premultiplies and demultiplies alpha, which changes
+    semi-transparent pixels, so it is used only while all tiles are opaque.
+    From the first tile with transparency on, pixel rows are copied into
+    PNG scanlines, which are wrapped into an uncompressed PNG and decoded
+    by image(). Tiles can be added again, replacing older pixels.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.result = mapnik.Image(width, height)
+        self.lines = None
+
+    def add_tile(self, x, y, im):
+        """Put image im with its top left corner at (x, y)"""
+        data = image_to_string(im)
+        if self.lines is None and data[3::4].strip(b'\xff'):
+            self.lines = self.scanlines(image_to_string(self.result))
+            self.result = None
+        if self.lines is None:
+            self.result.composite(im, mapnik.CompositeOp.src, 1.0, x, y)
+            return
+        stride = self.width * 4 + 1
+        row_size = im.width() * 4
+        for row in range(im.height()):
+            pos = (y + row) * stride + 1 + x * 4
+            self.lines[pos:pos + row_size] = data[row * row_size:(row + 1) * row_size]
+
+    def scanlines(self, data):
+        """Make PNG scanlines with filter type 0 (none) from raw pixels"""
+        row_size = self.width * 4
+        lines = bytearray((row_size + 1) * self.height)
+        for row in range(self.height):
+            pos = row * (row_size + 1) + 1
+            lines[pos:pos + row_size] = data[row * row_size:(row + 1) * row_size]
+        return lines
+
+    def image(self):
+        """Return the joined mapnik.Image"""
+        if self.lines is None:
+            return self.result
+        png = b''.join([
+            PNG_SIGNATURE,
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 6, 0, 0, 0)),
+            png_chunk(b'IDAT', zlib.compress(self.lines, 0)),
+            png_chunk(b'IEND', b'')])
+        return image_from_string(png)
+
+
+class GeoTIFFWriter(object):
+    """Write a tiled, deflate-compressed RGBA GeoTIFF.
+
+    levels is a list of (width, height) for the image and its overviews,
+    and geo_tags is a dict of GeoTIFF tags for the first directory. Space
+    for all directories is reserved at the start of the file, so tiles can
+    be added in any order as they are rendered. outfile is a file name or
+    a seekable file object.
+    """
+
+    def __init__(self, outfile, levels, geo_tags, tile_size=GEOTIFF_TILE):
+        if hasattr(outfile, 'write'):
+            self.f = outfile
+            self.own_file = False
+        else:
+            self.f = open(outfile, 'w+b')
+            self.own_file = True
+        self.levels = levels
+        self.geo_tags = geo_tags
+        self.tile_size = tile_size
+        # classic tiff cannot address more than 4 GB, estimate by uncompressed size
+        self.bigtiff = sum(w * h * 4 for w, h in levels) >= 2**32
+        self.offsets = []
+        self.counts = []
+        for w, h in levels:
+            count = self.tiles_across(w) * self.tiles_across(h)
+            self.offsets.append([0] * count)
+            self.counts.append([0] * count)
+        self.start = self.f.tell()
+        self.header_size = 16 if self.bigtiff else 8
+        self.pos = self.header_size + len(self.directories(self.header_size))
+        self.f.write(b'\0' * self.pos)
+
+    def tiles_across(self, pixels):
+        return int(math.ceil(1.0 * pixels / self.tile_size))
+
+    def add_tile(self, level, x, y, im):
+        """Write image im placed at (x, y) of level, x and y are multiples of tile size"""
+        t = self.tile_size
+        width = self.levels[level][0]
+        for ty in range(y // t, self.tiles_across(y + im.height())):
+            for tx in range(x // t, self.tiles_across(x + im.width())):
+                bw = min(t, x + im.width() - tx * t)
+                bh = min(t, y + im.height() - ty * t)
+                data = image_to_string(im.view(tx * t - x, ty * t - y, bw, bh))
+                if bw < t or bh < t:
+                    # edge tiles are padded to full size
+                    pad = b'\0' * ((t - bw) * 4)
+                    data = b''.join([data[i * bw * 4:(i + 1) * bw * 4] + pad for i in range(bh)] +
+                                    [b'\0' * (t * 4 * (t - bh))])
+                data = zlib.compress(data, 6)
+                index = ty * self.tiles_across(width) + tx
+                self.f.seek(self.start + self.pos)
+                self.f.write(data)
+                self.offsets[level][index] = self.pos
+                self.counts[level][index] = len(data)
+                self.pos += len(data) + len(data) % 2
+
+    def directory(self, level, start, next_start):
+        """Encode a tiff directory with its values, starting at offset start"""
+        w, h = self.levels[level]
+        big = self.bigtiff
+        offset_type = 16 if big else 4
+        tags = {
+            254: (4, [0 if level == 0 else 1]),  # NewSubfileType: overview
+            256: (4, [w]),
+            257: (4, [h]),
+            258: (3, [8, 8, 8, 8]),  # BitsPerSample
+            259: (3, [8]),  # Compression: deflate
+            262: (3, [2]),  # PhotometricInterpretation: RGB
+            277: (3, [4]),  # SamplesPerPixel
+            284: (3, [1]),  # PlanarConfiguration: chunky
+            322: (3, [self.tile_size]),
+            323: (3, [self.tile_size]),
+            324: (offset_type, self.offsets[level]),
+            325: (offset_type, self.counts[level]),
+            338: (3, [2]),  # ExtraSamples: unassociated alpha
+        }
+        if level == 0:
+            tags.update(self.geo_tags)
+
+        if big:
+            entry_fmt, number_fmt, offset_fmt = '<HHQ', '<Q', '<Q'
+        else:
+            entry_fmt, number_fmt, offset_fmt = '<HHI', '<H', '<I'
+        value_size = struct.calcsize(offset_fmt)
+        entries = []
+        data = []
+        data_pos = start + struct.calcsize(number_fmt) + len(tags) * (
+            struct.calcsize(entry_fmt) + value_size) + value_size
+        for tag in sorted(tags):
+            typ, values = tags[tag]
+            if typ == 2:
+                value = values.encode('ascii') + b'\0'
+                count = len(value)
+            else:
+                value = struct.pack('<{}{}'.format(len(values), TIFF_TYPES[typ]), *values)
+                count = len(values)
+            entry = struct.pack(entry_fmt, tag, typ, count)
+            if len(value) <= value_size:
+                entry += value + b'\0' * (value_size - len(value))
+            else:
+                entry += struct.pack(offset_fmt, data_pos)
+                value += b'\0' * (len(value) % 2)
+                data.append(value)
+                data_pos += len(value)
+            entries.append(entry)
+        ifd = b''.join([struct.pack(number_fmt, len(tags))] + entries +
+                       [struct.pack(offset_fmt, next_start)])
+        return ifd + b''.join(data)
+
+    def directories(self, start):
+        """Encode all directories, one after another from offset start"""
+        sizes = [len(self.directory(level, 0, 0)) for level in range(len(self.levels))]
+        result = []
+        for level in range(len(self.levels)):
+            next_start = start + sizes[level] if level < len(self.levels) - 1 else 0
+            result.append(self.directory(level, start, next_start))
+            start += sizes[level]
+        return b''.join(result)
+
+    def close(self):
+        self.f.seek(self.start)
+        if self.bigtiff:
+            self.f.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, self.header_size))
+        else:
+            self.f.write(struct.pack('<2sHI', b'II', 42, self.header_size))
+        self.f.write(self.directories(self.header_size))
+        self.f.seek(self.start + self.pos)
+        if self.own_file:
+            self.f.close()
+
+
+def geotiff_tags(bbox, size, proj_target, projection):
+    """Make GeoTIFF tags for an image of given size covering bbox"""
+    epsg = None
+    if projection.isdigit():
+        epsg = int(projection)
+    elif projection == EPSG_3857:
+        epsg = 3857
+    else:
+        match = re.search(r'epsg:(\d+)', projection, flags=re.IGNORECASE)
+        if match:
+            epsg = int(match.group(1))
+    geographic = proj_target.geographic
+    citation = proj_target.params() + '|'
+    keys = [
+        (1024, 0, 1, 2 if geographic else 1),  # GTModelTypeGeoKey
+        (1025, 0, 1, 1),  # GTRasterTypeGeoKey: PixelIsArea
+        (1026, 34737, len(citation), 0),  # GTCitationGeoKey
+        (2048 if geographic else 3072, 0, 1, epsg or 32767),  # Geographic/ProjectedCSTypeGeoKey
+    ]
+    key_directory = [1, 1, 0, len(keys)]
+    for key in keys:
+        key_directory.extend(key)
+    return {
+        33550: (12, [(bbox.maxx - bbox.minx) / size[0], (bbox.maxy - bbox.miny) / size[1], 0.0]),
+        33922: (12, [0.0, 0.0, 0.0, bbox.minx, bbox.maxy, 0.0]),
+        34735: (3, key_directory),
+        34737: (2, citation),
+    }
+
+
+def write_geotiff(outfile, m, bbox, size, map_size, scale_factor, pool, proj_target, projection,
+                  overviews, extents=None, profiler=None):
+    """Render map m tile by tile into a GeoTIFF, with optional overview levels.
+
+    map_size is size of a rendered tile, its dimensions are multiples of
+    GEOTIFF_TILE. Overviews are rendered with reduced scale factor,
+    smallest first, as cloud-optimized GeoTIFF suggests.
+    """
+    levels = [tuple(size)]
+    while overviews and max(levels[-1]) > GEOTIFF_TILE:
+        levels.append(tuple(int(math.ceil(d / 2.0)) for d in levels[-1]))
+    writer = GeoTIFFWriter(outfile, levels, geotiff_tags(bbox, size, proj_target, projection))
+    for level in reversed(range(len(levels))):
+        level_size = levels[level]
+        tile_size = [min(map_size[i], int(math.ceil(1.0 * level_size[i] / GEOTIFF_TILE)) *
+                         GEOTIFF_TILE) for i in (0, 1)]
+        tiles = tile_grid(bbox, level_size, tile_size[0], tile_size[1])
+        logging.debug('tiff level %s: size=%s,%s tiles=%s', level, level_size[0], level_size[1],
+                      len(tiles))
+        for row, column, im in render_tiles(m, tiles, tile_size, scale_factor / 2**level, pool,
+                                            extents=extents, profiler=profiler, level=level):
+            start = time.time()
+            writer.add_tile(level, column * tile_size[0], row * tile_size[1], im)
+            if profiler:
+                profiler.tile((level, row, column), encode=time.time() - start)
+    writer.close()
+
+
+def layer_extents(m, proj_target, features=False):
+    """Make an index of where active layers have data, for skipping empty tiles.
+
+    Returns a list with an item for each layer of m: None when the extent is
+    unknown or the layer is inactive, or a list of (minx, miny, maxx, maxy)
+    in the target projection: the layer extent, or bounding boxes of all
+    its features when features is True.
+    """
+    extents = []
+    for layer in m.layers:
+        boxes = None
+        if layer.active and layer.datasource is not None:
+            try:
+                box_trans = mapnik.ProjTransform(mapnik.Projection(layer.srs), proj_target)
+                envelope = layer.envelope()
+                if features:
+                    query = mapnik.Query(envelope)
+                    boxes = [box_tuple(box_trans.forward(f.envelope()))
+                             for f in layer.datasource.features(query)]
+                else:
+                    boxes = [box_tuple(box_trans.forward(envelope))]
+            except Exception as e:
+                logging.debug('no extent for layer %s: %s', layer.name, e)
+                boxes = None
+        extents.append(boxes)
+    return extents
+
+
+def boxes_intersect(box, boxes):
+    """Test if a (minx, miny, maxx, maxy) box intersects any of boxes"""
+    for b in boxes:
+        if b[0] <= box[2] and box[0] <= b[2] and b[1] <= box[3] and box[1] <= b[3]:
+            return True
+    return False
+
+
+def count_features(m, layer):
+    """Count features of a layer inside the map envelope, or None if it fails"""
+    try:
+        box_trans = mapnik.ProjTransform(mapnik.Projection(layer.srs), mapnik.Projection(m.srs))
+        query = mapnik.Query(box_trans.backward(m.envelope()))
+        return sum(1 for _ in layer.datasource.features(query))
+    except Exception as e:
+        logging.debug('cannot count features of layer %s: %s', layer.name, e)
+        return None
+
+
+def profile_layers(m, size, scale_factor, mode='alone'):
+    """Measure render time of each active layer of m over its current envelope.
+
+    In 'alone' mode every layer is rendered on its own, in 'without' mode the
+    map is rendered with all layers except one, and the layer cost is the
+    difference with the full render. Returns the full render time and a list
+    of (name, seconds, feature count) sorted by seconds, largest first.
+    """
+    active = [l.name for l in m.layers if l.active]
+
+    def timed_render():
+        im = mapnik.Image(size[0], size[1])
+        start = time.time()
+        mapnik.render(m, im, scale_factor)
+        return time.time() - start
+
+    # the first render loads fonts and images, so it is not counted
+    timed_render()
+    total = timed_render()
+    result = []
+    try:
+        for layer in m.layers:
+            if layer.name not in active:
+                continue
+            if mode == 'without':
+                filter_layers(m, [n for n in active if n != layer.name])
+                seconds = max(0, total - timed_render())
+            else:
+                filter_layers(m, [layer.name])
+                seconds = timed_render()
+            result.append((layer.name, seconds, count_features(m, layer)))
+    finally:
+        filter_layers(m, active)
+    result.sort(key=lambda r: r[1], reverse=True)
+    return total, result
+
+
+def print_layer_profile(total, layers, mode, stream=None):
+    """Print a table from profile_layers() results"""
+    if stream is None:
+        stream = sys.stdout
+    width = max([5] + [len(l[0]) for l in layers])
+    share_base = total if mode == 'without' else sum(l[1] for l in layers)
+    stream.write('{:<{w}}  {:>9}  {:>9}  {:>6}\n'.format(
+        'layer', 'time, ms', 'features', 'share', w=width))
+    for name, seconds, features in layers:
+        stream.write('{:<{w}}  {:>9.1f}  {:>9}  {:>5.1f}%\n'.format(
+            name, seconds * 1000, '?' if features is None else features,
+            100.0 * seconds / share_base if share_base else 0, w=width))
+    stream.write('Full render ({} layers): {:.1f} ms\n'.format(len(layers), total * 1000))
+
+
+def render_tile(m, tile_bbox, tile_size, scale_factor, extents=None):
+    """Render one tile of a tiled map into a new image.
+
+    With extents from layer_extents(), layers that have no data in the
+    tile are not rendered, and a tile without data is just filled with
+    the background color.
+    """
+    m.zoom_to_box(tile_bbox)
+    im = mapnik.Image(tile_size[0], tile_size[1])
+    if extents is None:
+        mapnik.render(m, im, scale_factor)
+        return im
+
+    # labels and symbols can come from features in the buffer
+    pad = TILE_BUFFER * scale_factor * (tile_bbox.maxx - tile_bbox.minx) / m.width
+    query = (tile_bbox.minx - pad, min(tile_bbox.miny, tile_bbox.maxy) - pad,
+             tile_bbox.maxx + pad, max(tile_bbox.miny, tile_bbox.maxy) + pad)
+    skipped = [l for l, boxes in zip(m.layers, extents)
+               if l.active and boxes is not None and not boxes_intersect(query, boxes)]
+    active = [l for l in m.layers if l.active]
+    if len(skipped) == len(active) and not m.background_image:
+        logging.debug('empty tile: %s', tile_bbox)
+        if m.background:
+            im.fill(m.background)
+        return im
+    for l in skipped:
+        l.active = False
+    try:
+        mapnik.render(m, im, scale_factor)
+    finally:
+        for l in skipped:
+            l.active = True
+    return im
+
+
+def write_tile_metadata(tile_name, tile_bbox, tile_size, transform, wld=False, ozi=False):
+    """Write ozi/wld files next to a tile if needed"""
+    if '.' not in tile_name:
+        tile_basename = tile_name + '.'
+    else:
+        tile_basename = tile_name[0:tile_name.rindex('.')+1]
+    if ozi:
+        with open(tile_basename + 'ozi', 'w') as f:
+            f.write(prepare_ozi(tile_bbox, tile_size[0], tile_size[1],
+                                tile_basename + '.ozi', transform))
+    if wld:
+        with open(tile_basename + 'wld', 'w') as f:
+            f.write(prepare_wld(tile_bbox, tile_size[0], tile_size[1]))
+
+
+def save_tile(im, tile_name, fmt, tile_bbox, tile_size, transform, wld=False, ozi=False,
+              palette=None):
+    """Save a tile image with its ozi/wld files, return seconds spent"""
+    start = time.time()
+    save_image(im, tile_name, fmt, palette)
+    write_tile_metadata(tile_name, tile_bbox, tile_size, transform, wld, ozi)
+    return time.time() - start
+
+
+class WritePipeline(object):
+    """Runs functions in a few threads, keeping at most depth of them queued.
+
+    Mapnik releases the GIL while rendering, so tiles can be encoded and
+    written while the next one renders. submit() blocks when the queue is
+    full, so only a few rendered tiles are kept in memory. Errors are raised
+    from submit() or close().
+    """
+    def __init__(self, threads=WRITE_THREADS, depth=WRITE_QUEUE):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(threads)
+        self.depth = depth
+        self.pending = collections.deque()
+
+    def submit(self, fn, *args):
+        while len(self.pending) >= self.depth:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def close(self):
+        """Wait for all queued functions and stop the threads"""
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
+
+
+# Map object and layer extents of a tile rendering process, see init_tile_worker()
+_worker_map = None
+_worker_extents = None
+
+
+def init_tile_worker(style_xml, style_path, srs, active_layers, fonts, extents=None):
+    """Load the style once per worker process, set up like the map in run()"""
+    global _worker_map, _worker_extents
+    if fonts:
+        for f in fonts:
+            add_fonts(f)
+    m = mapnik.Map(100, 100)  # resized for every tile
+    mapnik.load_map_from_string(m, style_xml.encode("utf-8"), False, style_path)
+    m.srs = srs
+    filter_layers(m, active_layers)
+    m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+    m.buffer_size = TILE_BUFFER
+    _worker_map = m
+    _worker_extents = extents
+
+
+def render_tile_task(task):
+    """Render a tile in a worker process.
+
+    Saves the tile when tile_name is given, otherwise returns it encoded
+    in TILE_TRANSFER_FORMAT for joining in the main process.
+    Returns (row, column, data, render seconds, encode seconds)."""
+    row, column, tile_bbox, tile_size, map_size, scale_factor, fmt, tile_name, palette = task
+    start = time.time()
+    _worker_map.resize(map_size[0], map_size[1])
+    im = render_tile(_worker_map, mapnik.Box2d(*tile_bbox), tile_size, scale_factor,
+                     _worker_extents)
+    rendered = time.time()
+    if tile_name:
+        save_image(im, tile_name, fmt, palette)
+        data = None
+    else:
+        data = image_to_string(im, TILE_TRANSFER_FORMAT)
+    return row, column, data, rendered - start, time.time() - rendered
+
+
+def create_tile_pool(jobs, m, style_xml, style_path, fonts, extents=None):
+    """Start processes for rendering tiles of map m"""
+    active = [l.name for l in m.layers if l.active]
+    return multiprocessing.Pool(jobs or None, initializer=init_tile_worker,
+                                initargs=(style_xml, style_path, m.srs, active, fonts, extents))
+
+
+def parse_bytes(value):
+    """Parse a size in bytes with an optional K, M, G or T suffix"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', value, flags=re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError('Incorrect size: ' + value)
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
+def available_memory():
+    """Free physical memory in bytes, or None if it cannot be found out"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def tile_memory(size, tiles, fmt, workers, joined, strips):
+    """Estimate peak memory in bytes for rendering an image of size in tiles"""
+    width = int(math.ceil(1.0 * size[0] / tiles[0]))
+    height = int(math.ceil(1.0 * size[1] / tiles[1]))
+    # every worker holds a tile with its buffer, and a copy for transfer
+    total = workers * (width + 2 * TILE_BUFFER) * (height + 2 * TILE_BUFFER) * 4 * 2
+    if strips:
+        # a row of tiles, and its filtered scanlines for compression
+        total += size[0] * height * (4 + 5)
+    elif joined:
+        # the joined image, and the encoder's copy of it
+        total += size[0] * size[1] * (4 + ENCODE_BYTES.get(fmt.split(':')[0], 4))
+    return total
+
+
+def plan_tile_grid(size, fmt, options):
+    """Choose tiles_x and tiles_y for --tiles auto.
+
+    Takes the fewest tiles that are within the mapnik size limit, give
+    work to every process of --jobs, and fit into --max-memory (half of
+    free memory by default) with the joined image.
+    Returns (tiles_x, tiles_y, estimated bytes).
+    """
+    workers = options.jobs or multiprocessing.cpu_count()
+    budget = options.max_memory
+    if not budget:
+        free = available_memory()
+        budget = free // 2 if free else 1024**3
+    joined = not options.just_tiles and fmt not in GEOTIFF_FORMATS
+    # tiles smaller than 256 pixels are not worth a process
+    max_count = int(math.ceil(size[0] / 256.0)) * int(math.ceil(size[1] / 256.0))
+    workers = min(workers, max_count)
+    for count in range(1, max_count + 1):
+        # tiles close to squares
+        tiles_x = max(1, min(count, int(round(math.sqrt(1.0 * count * size[0] / size[1])))))
+        tiles_y = int(math.ceil(1.0 * count / tiles_x))
+        if (size[0] / tiles_x > 16384 or size[1] / tiles_y > 16384
+                or tiles_x * tiles_y < workers):
+            continue
+        memory = tile_memory(size, (tiles_x, tiles_y), fmt, workers, joined, options.strips)
+        if memory <= budget:
+            return tiles_x, tiles_y, memory
+    raise Exception('Cannot render {}x{} pixels in {} MB of memory, use --strips, a GeoTIFF '
+                    'or a larger --max-memory'.format(size[0], size[1], budget // 1024**2))
+
+
+def fix_aspect(bbox, size):
+    """Grow bbox to the aspect ratio of image size, in place"""
+    # we cannot make mapnik calculate scale for us, so fixing aspect ratio outselves
+    rdiff = (bbox.maxx-bbox.minx) / (bbox.maxy-bbox.miny) - size[0] / size[1]
+    if rdiff > 0:
+        bbox.height((bbox.maxx - bbox.minx) * size[1] / size[0])
+    elif rdiff < 0:
+        bbox.width((bbox.maxy - bbox.miny) * size[0] / size[1])
+
+
+def tile_grid(bbox, size, width, height):
+    """Split bbox of an image of given size into tiles of width×height pixels.
+
+    Returns a list of (row, column, tile_bbox, tile_size). Tiles in the last
+    row and column can be smaller.
+    """
+    scale = (bbox.maxx - bbox.minx) / size[0]
+    tile_cnt = [int(math.ceil(1.0 * size[0] / width)),
+                int(math.ceil(1.0 * size[1] / height))]
+    tiles = []
+    for row in range(0, tile_cnt[1]):
+        for column in range(0, tile_cnt[0]):
+            tile_bbox = mapnik.Box2d(
+                bbox.minx + 1.0 * width * scale * column,
+                bbox.maxy - 1.0 * height * scale * row,
+                bbox.minx + 1.0 * width * scale * (column + 1),
+                bbox.maxy - 1.0 * height * scale * (row + 1))
+            tile_size = [
+                width if column < tile_cnt[0] - 1 else size[0] - width * (tile_cnt[0] - 1),
+                height if row < tile_cnt[1] - 1 else size[1] - height * (tile_cnt[1] - 1)]
+            tiles.append((row, column, tile_bbox, tile_size))
+    return tiles
+
+
+def render_tiles(m, tiles, map_size, scale_factor, pool=None, fmt=None, names=None,
+                 extents=None, profiler=None, level=0, palette=None):
+    """Render tiles from tile_grid() with map m, or in a worker pool.
+
+    Yields (row, column, image) in any order. When names dict is given, tiles
+    are saved to files names[row, column] in fmt format with palette, and
+    image is None.
+    For extents, see render_tile(); a pool gets them on creation.
+    Tile timings are added to profiler under (level, row, column) key.
+    """
+    if pool:
+        tasks = [(row, column, box_tuple(tile_bbox), tile_size, map_size, scale_factor, fmt,
+                  names[row, column] if names else None, palette)
+                 for row, column, tile_bbox, tile_size in tiles]
+        for row, column, data, render_time, encode_time in pool.imap_unordered(
+                render_tile_task, tasks):
+            start = time.time()
+            im = image_from_string(data) if data is not None else None
+            if profiler:
+                profiler.tile((level, row, column), render=render_time,
+                              encode=encode_time + time.time() - start)
+            yield row, column, im
+    else:
+        m.resize(map_size[0], map_size[1])
+        for row, column, tile_bbox, tile_size in tiles:
+            start = time.time()
+            im = render_tile(m, tile_bbox, tile_size, scale_factor, extents)
+            rendered = time.time()
+            if names:
+                save_image(im, names[row, column], fmt, palette)
+                im = None
+            if profiler:
+                profiler.tile((level, row, column), render=rendered - start,
+                              encode=time.time() - rendered)
+            yield row, column, im
+
+
+def datasource_params(layer):
+    """Get parameters of a layer datasource as a dict"""
+    ds = layer.datasource
+    params = ds.parameters() if hasattr(ds, 'parameters') else ds.params()
+    return dict((k, params[k]) for k in params.keys())
+
+
+def layer_files(layer, style_path=''):
+    """List files read by the datasource of a layer"""
+    files = []
+    if layer.datasource is None:
+        return files
+    params = datasource_params(layer)
+    if 'file' not in params:
+        return files
+    path = os.path.join(params.get('base', style_path), params['file'])
+    stem = path[:-4] if path.lower().endswith('.shp') else path
+    for name in (path, stem + '.shp', stem + '.dbf', stem + '.shx', stem + '.index'):
+        if os.path.isfile(name) and name not in files:
+            files.append(name)
+    return files
+
+
+def datasource_files(m, style_path):
+    """List files read by datasources of active layers"""
+    files = set()
+    for layer in m.layers:
+        if layer.active:
+            files.update(layer_files(layer, style_path))
+    return sorted(files)
+
+
+# Layer envelopes by datasource, see layer_envelope()
+_envelopes = {}
+
+
+def layer_envelope(layer, cache_dir=None):
+    """Get extent of a layer, cached for datasources that read files.
+
+    Envelopes are kept in memory, and in ENVELOPE_CACHE in cache_dir when
+    it is given, under a hash of datasource parameters together with
+    modification times and sizes of its files; an entry is replaced when
+    the files change. Database layers are not cached, since there is no
+    way to know if their data has changed.
+    """
+    files = [os.path.abspath(name) for name in layer_files(layer)]
+    if not files:
+        return layer.envelope()
+    key = hashlib.sha1(repr((sorted(datasource_params(layer).items()), layer.srs, files))
+                       .encode('utf-8')).hexdigest()
+    stamp = [[name, os.path.getmtime(name), os.path.getsize(name)] for name in files]
+    entry = _envelopes.get(key)
+    cache_file = os.path.join(cache_dir, ENVELOPE_CACHE) if cache_dir else None
+    if (not entry or entry['stamp'] != stamp) and cache_file:
+        try:
+            with open(cache_file, 'r') as f:
+                entry = json.load(f).get(key)
+        except (IOError, ValueError):
+            entry = None
+    if entry and entry['stamp'] == stamp:
+        _envelopes[key] = entry
+        return mapnik.Box2d(*entry['bbox'])
+
+    envelope = layer.envelope()
+    entry = {'stamp': stamp, 'bbox': box_tuple(envelope)}
+    _envelopes[key] = entry
+    if cache_file:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        try:
+            with open(cache_file, 'r') as f:
+                envelopes = json.load(f)
+        except (IOError, ValueError):
+            envelopes = {}
+        envelopes[key] = entry
+        tmp_file = '{}.{}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(envelopes, f)
+        os.replace(tmp_file, cache_file)
+    return envelope
+
+
+def render_cache_key(style_xml, style_path, m, size, scale_factor, fmt, tiles, strips=False,
+                     palette=None):
+    """Hash everything that affects the rendered image"""
+    h = hashlib.sha1(style_xml.encode('utf-8'))
+    h.update(repr((box_tuple(m.envelope()), list(size), scale_factor, fmt, tiles, strips, m.srs,
+                   [l.name for l in m.layers if l.active])).encode('utf-8'))
+    if palette:
+        h.update(palette)
+    for name in datasource_files(m, style_path):
+        st = os.stat(name)
+        h.update(repr((name, st.st_mtime, st.st_size)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def update_cache_stats(cache_dir, **counters):
+    """Add numbers to cache statistics in stats.json"""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    stats_file = os.path.join(cache_dir, 'stats.json')
+    try:
+        with open(stats_file, 'r') as f:
+            stats = json.load(f)
+    except (IOError, ValueError):
+        stats = {}
+    for k, v in counters.items():
+        stats[k] = stats.get(k, 0) + v
+    tmp_file = '{}.{}'.format(stats_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(stats, f, sort_keys=True)
+    os.replace(tmp_file, stats_file)
+    logging.debug('cache stats: %s', stats)
+
+
+def cache_get(cache_dir, key, outfile):
+    """Copy cached image to outfile (a path or a file object).
+
+    Returns bbox of the cached image, or None if it's not in the cache.
+    """
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(entry + '.json', 'r') as f:
+            meta = json.load(f)
+        if hasattr(outfile, 'write'):
+            with open(entry, 'rb') as f:
+                shutil.copyfileobj(f, outfile)
+        else:
+            shutil.copyfile(entry, outfile)
+    except (IOError, OSError, ValueError):
+        update_cache_stats(cache_dir, misses=1)
+        return None
+    # touch the entry, so eviction would remove least recently used ones
+    os.utime(entry + '.json', None)
+    update_cache_stats(cache_dir, hits=1)
+    return mapnik.Box2d(*meta['bbox'])
+
+
+def cache_put(cache_dir, key, outfile, bbox, max_bytes):
+    """Store rendered image in the cache and evict old entries over max_bytes"""
+    entry = os.path.join(cache_dir, key)
+    if hasattr(outfile, 'write'):
+        outfile.seek(0)
+        with open(entry, 'wb') as f:
+            shutil.copyfileobj(outfile, f)
+    else:
+        shutil.copyfile(outfile, entry)
+    with open(entry + '.json', 'w') as f:
+        json.dump({'bbox': box_tuple(bbox)}, f)
+
+    # least recently used entries go first
+    # other renders can evict the same entries at the same time
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.json') and name not in ('stats.json', ENVELOPE_CACHE):
+            path = os.path.join(cache_dir, name[:-5])
+            try:
+                mtime = os.path.getmtime(path + '.json')
+            except FileNotFoundError:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                size = 0
+            entries.append((mtime, path, size))
+    entries.sort()
+    total = sum(e[2] for e in entries)
+    evicted = 0
+    while max_bytes and total > max_bytes and len(entries) > 1:
+        _, path, size = entries.pop(0)
+        total -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(path + '.json')
+            evicted += 1
+        except FileNotFoundError:
+            pass
+    if evicted:
+        update_cache_stats(cache_dir, evictions=evicted)
+
+
+class MapCache(collections.OrderedDict):
+    """Loaded maps for load_style(), keeping only maxsize recently used ones"""
+
+    def __init__(self, maxsize=MAP_CACHE_SIZE):
+        super(MapCache, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super(MapCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(MapCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def load_style(options, proj_target, maps=None):
+    """Read and preprocess the style file, and create a Map object from it.
+
+    Returns a tuple of (map, style_xml, style_path, buffer_size). When a maps
+    dict or a MapCache is given, loaded maps are kept there and reused for
+    the same style, variables and layer lists.
+    """
+    key = None
+    if maps is not None:
+        key = (options.style, options.base, tuple(options.vars or []), options.layers,
+               options.add_layers, options.hide_layers, options.fit, proj_target.params())
+        if key in maps:
+            return maps[key]
+
+    # reading style xml into memory for preprocessing
+    if options.style == '-':
+        style_xml = sys.stdin.read()
+        style_path = ''
+    else:
+        with codecs.open(options.style, 'r', 'utf-8') as style_file:
+            style_xml = style_file.read()
+        style_path = os.path.dirname(options.style)
+    if options.base:
+        style_path = options.base
+    layers = parse_layers_string(options.layers)
+    add_layers = parse_layers_string(options.add_layers)
+    hide_layers = parse_layers_string(options.hide_layers)
+    fit_layers = parse_layers_string(options.fit)
+    style_xml = preprocess_style(style_xml, options.vars, layers + add_layers,
+                                 layer_keeper(layers, add_layers, hide_layers, fit_layers))
+
+    # for layer processing we need to create the Map object
+    m = mapnik.Map(100, 100)  # temporary size, will be changed before output
+    mapnik.load_map_from_string(m, style_xml.encode("utf-8"), False, style_path)
+    m.srs = proj_target.params()
+
+    # add / remove some layers
+    if options.layers:
+        filter_layers(m, parse_layers_string(options.layers))
+    if options.add_layers or options.hide_layers:
+        select_layers(m, parse_layers_string(options.add_layers),
+                      parse_layers_string(options.hide_layers))
+
+    result = (m, style_xml, style_path, m.buffer_size)
+    if key is not None:
+        maps[key] = result
+    return result
+
+
+MapPlan = collections.namedtuple('MapPlan', 'fmt bbox size scale scale_factor')
+
+
+def plan_map(options, m, proj_target, extent=None):
+    """Calculate output format, bounding box and size in pixels from options.
+
+    Layer extents for --fit are taken from extent, when it was calculated
+    beforehand with layer_bbox(), or from map m, which is not changed.
+    Returns a MapPlan with the bbox in proj_target projection, scale in
+    projection units per pixel (None when it was not specified) and
+    the mapnik scale factor.
+    """
     dim_mm = None
     scale = None
     size = None
     bbox = None
     rotate = not options.norotate
 
-    # register non-standard fonts
-    if options.fonts:
-        for f in options.fonts:
-            add_fonts(f)
-
-    if (options.ozi and options.projection.lower() != 'epsg:3857'
-            and options.projection != EPSG_3857):
-        raise Exception('Ozi map file output is only supported for Web Mercator (EPSG:3857). ' +
-                        'Please remove --projection.')
-
     if options.url:
+        options = copy.copy(options)
         parse_url(options.url, options)
 
     # format should not be empty
     if options.fmt:
         fmt = options.fmt.lower()
-    elif '.' in options.output:
+    elif options.output and '.' in options.output:
         fmt = options.output.split('.')[-1].lower()
     else:
         fmt = 'png256'
+    if fmt.split(':')[0] == 'jpg':
+        # mapnik knows only the full name
+        fmt = 'jpeg' + fmt[3:]
 
     need_cairo = fmt in ['svg', 'pdf']
-
-    # output projection
-    if options.projection.isdigit():
-        proj_target = mapnik.Projection('+init=epsg:{}'.format(options.projection))
-    else:
-        proj_target = mapnik.Projection(options.projection)
-    transform = mapnik.ProjTransform(proj_lonlat, proj_target)
+    transform = mapnik.ProjTransform(get_projection(EPSG_4326), proj_target)
 
     # get image size in millimeters
     if options.paper:
@@ -322,19 +1604,20 @@ def run(options):
         if options.paper[0] == '-':
             portrait = True
             rotate = False
-            options.paper = options.paper[1:]
+            paper = options.paper[1:]
         elif options.paper[0] == '+':
             rotate = False
-            options.paper = options.paper[1:]
+            paper = options.paper[1:]
         else:
             rotate = True
-        dim_mm = get_paper_size(options.paper.lower())
+            paper = options.paper
+        dim_mm = get_paper_size(paper.lower())
         if not dim_mm:
-            raise Exception('Incorrect paper format: ' + options.paper)
+            raise Exception('Incorrect paper format: ' + paper)
         if portrait:
             dim_mm = [dim_mm[1], dim_mm[0]]
     elif options.size:
-        dim_mm = options.size
+        dim_mm = list(options.size)
     if dim_mm and options.margin:
         dim_mm[0] = max(0, dim_mm[0] - options.margin * 2)
         dim_mm[1] = max(0, dim_mm[1] - options.margin * 2)
@@ -348,14 +1631,14 @@ def run(options):
         ppmm = 90.7 / 25.4 * scale_factor
 
     # svg / pdf can be scaled only in cairo mode
-    if scale_factor != 1 and need_cairo and not HAS_CAIRO:
+    if scale_factor != 1 and need_cairo and not has_cairo():
         logging.error('Warning: install pycairo for using --factor or --ppi')
         scale_factor = 1
         ppmm = 90.7 / 25.4
 
     # convert physical size to pixels
     if options.size_px:
-        size = options.size_px
+        size = list(options.size_px)
     elif dim_mm:
         size = [int(round(dim_mm[0] * ppmm)), int(round(dim_mm[1] * ppmm))]
 
@@ -367,7 +1650,8 @@ def run(options):
 
     # scale can be specified with zoom or with 1:NNN scale
     fix_scale = False
-    if options.zoom:
+    # zoom 0 shows the whole world
+    if options.zoom is not None:
         scale = 2 * 3.14159 * 6378137 / 2 ** (options.zoom + 8) / scale_factor
     elif options.scale:
         scale = options.scale * 0.00028 / scale_factor
@@ -383,7 +1667,7 @@ def run(options):
     # all calculations are in EPSG:3857 projection (it's easier)
     if bbox:
         bbox = transform.forward(mapnik.Box2d(*bbox))
-        bbox_web_merc = transform_lonlat_webmerc.forward(mapnik.Box2d(*(options.bbox)))
+        bbox_web_merc = lonlat_webmerc().forward(mapnik.Box2d(*(options.bbox)))
         if scale:
             scale = correct_scale(bbox, scale, bbox_web_merc, bbox)
 
@@ -391,11 +1675,11 @@ def run(options):
     if not bbox and options.center and size and size[0] > 0 and size[1] > 0 and scale:
         # We don't know over which latitude range the bounding box spans, so we
         # first do everything in Web Mercator.
-        center = transform_lonlat_webmerc.forward(mapnik.Coord(*options.center))
+        center = lonlat_webmerc().forward(mapnik.Coord(*options.center))
         w = size[0] * scale / 2
         h = size[1] * scale / 2
         bbox_web_merc = mapnik.Box2d(center.x-w, center.y-h, center.x+w, center.y+h)
-        bbox = transform_lonlat_webmerc.backward(bbox_web_merc)
+        bbox = lonlat_webmerc().backward(bbox_web_merc)
         bbox = transform.forward(bbox)
         # now correct the scale
         scale = correct_scale(bbox, scale, bbox_web_merc, bbox)
@@ -404,35 +1688,18 @@ def run(options):
         h = size[1] * scale / 2
         bbox = mapnik.Box2d(center.x-w, center.y-h, center.x+w, center.y+h)
 
-    # reading style xml into memory for preprocessing
-    if options.style == '-':
-        style_xml = sys.stdin.read()
-        style_path = ''
-    else:
-        with codecs.open(options.style, 'r', 'utf-8') as style_file:
-            style_xml = style_file.read()
-        style_path = os.path.dirname(options.style)
-    if options.base:
-        style_path = options.base
-    if options.vars:
-        style_xml = xml_vars(style_xml, options.vars)
-    if options.layers or options.add_layers:
-        style_xml = reenable_layers(
-            style_xml, parse_layers_string(options.layers) +
-            parse_layers_string(options.add_layers))
-
-    # for layer processing we need to create the Map object
-    m = mapnik.Map(100, 100)  # temporary size, will be changed before output
-    mapnik.load_map_from_string(m, style_xml.encode("utf-8"), False, style_path)
-    m.srs = proj_target.params()
-
     # get bbox from layer extents
     if options.fit:
-        bbox = layer_bbox(m, options.fit.split(','), proj_target, bbox)
+        if extent is None:
+            extent = layer_bbox(m, options.fit.split(','), proj_target, None, options.cache_dir)
+        if bbox and extent:
+            bbox.expand_to_include(extent)
+        elif extent:
+            bbox = mapnik.Box2d(extent.minx, extent.miny, extent.maxx, extent.maxy)
         # here's where we can fix scale, no new bboxes below
         if bbox and fix_scale:
             scale = scale / math.cos(math.radians(transform.backward(bbox.center()).y))
-        bbox_web_merc = transform_lonlat_webmerc.forward(transform.backward(bbox))
+        bbox_web_merc = lonlat_webmerc().forward(transform.backward(bbox))
         if scale:
             scale = correct_scale(bbox, scale, bbox_web_merc, bbox)
         # expand bbox with padding in mm
@@ -467,7 +1734,187 @@ def run(options):
     elif size[1] == 0:
         size[1] = int(round(size[0] / (bbox.maxx - bbox.minx) * (bbox.maxy - bbox.miny)))
 
-    if options.output == '-' or (need_cairo and (options.tiles_x > 1 or options.tiles_y > 1)):
+    return MapPlan(fmt, bbox, size, scale, scale_factor)
+
+
+def plan_batch(sizes=None, zooms=None, scales=None, centers=None, bboxes=None,
+               scale_factor=1, projection=EPSG_3857, rotate=False):
+    """Calculate bounding boxes, scales and pixel sizes for many maps at once.
+
+    Arguments are arrays with an item for each map, or single values for all:
+    centers as (lon, lat) or bboxes as (minlon, minlat, maxlon, maxlat),
+    zooms or scales (1:N), and sizes in pixels, where zero width or height
+    is calculated from the bbox. Results are the same as plan_map() gives
+    for these options. For Web Mercator and WGS84 target projections the
+    math is vectorized with NumPy, other projections go through plan_map()
+    one map at a time.
+
+    Returns a tuple of NumPy arrays: bboxes in the target projection,
+    scales (NaN when neither zoom nor scale is given) and sizes.
+    """
+    import numpy
+    if centers is None and bboxes is None:
+        raise Exception('Bounding box was not specified in any way')
+    count = len(centers if centers is not None else bboxes)
+
+    def column(value, width=None):
+        if value is None:
+            return None
+        shape = (count,) if width is None else (count, width)
+        return numpy.broadcast_to(numpy.asarray(value, dtype=float), shape)
+
+    sizes = column(sizes, 2)
+    zooms = column(zooms)
+    scales = column(scales)
+    centers = column(centers, 2)
+    bboxes = column(bboxes, 4)
+
+    if projection not in (EPSG_3857, EPSG_4326):
+        return plan_batch_scalar(count, sizes, zooms, scales, centers, bboxes, scale_factor,
+                                 projection, rotate)
+
+    # spherical mercator with +over: no clipping at the antimeridian
+    def merc(lon, lat):
+        return (EARTH_RADIUS * numpy.radians(lon),
+                EARTH_RADIUS * numpy.log(numpy.tan(numpy.radians(90 + lat) / 2)))
+
+    def lonlat(x, y):
+        return (numpy.degrees(x / EARTH_RADIUS),
+                numpy.degrees(2 * numpy.arctan(numpy.exp(y / EARTH_RADIUS)) - math.pi / 2))
+
+    def target(lon, lat):
+        return merc(lon, lat) if projection == EPSG_3857 else (lon, lat)
+
+    # scale can be specified with zoom or with 1:NNN scale
+    if zooms is not None:
+        scale = 2 * 3.14159 * 6378137 / 2 ** (zooms + 8) / scale_factor
+    elif scales is not None:
+        lat = centers[:, 1] if centers is not None else (bboxes[:, 3] + bboxes[:, 1]) / 2
+        scale = scales * 0.00028 / scale_factor / numpy.cos(numpy.radians(lat))
+    else:
+        scale = numpy.full(count, numpy.nan)
+
+    if bboxes is not None:
+        minx, miny = target(bboxes[:, 0], bboxes[:, 1])
+        maxx, maxy = target(bboxes[:, 2], bboxes[:, 3])
+        merc_minx, _ = merc(bboxes[:, 0], bboxes[:, 1])
+        merc_maxx, _ = merc(bboxes[:, 2], bboxes[:, 3])
+        scale = scale * ((maxx - minx) / (merc_maxx - merc_minx))
+    else:
+        # the same steps as in plan_map(): from Web Mercator to WGS84 and to the target
+        if sizes is None or (sizes <= 0).any() or numpy.isnan(scale).any():
+            raise Exception('Bounding box was not specified in any way')
+        cx, cy = merc(centers[:, 0], centers[:, 1])
+        w = sizes[:, 0] * scale / 2
+        h = sizes[:, 1] * scale / 2
+        merc_minx, merc_maxx = cx - w, cx + w
+        minx, miny = target(*lonlat(merc_minx, cy - h))
+        maxx, maxy = target(*lonlat(merc_maxx, cy + h))
+        scale = scale * ((maxx - minx) / (merc_maxx - merc_minx))
+        cx, cy = target(centers[:, 0], centers[:, 1])
+        w = sizes[:, 0] * scale / 2
+        h = sizes[:, 1] * scale / 2
+        minx, miny, maxx, maxy = cx - w, cy - h, cx + w, cy + h
+    bbox = numpy.stack([minx, miny, maxx, maxy], axis=1)
+    width = maxx - minx
+    height = maxy - miny
+
+    if sizes is None:
+        if numpy.isnan(scale).any():
+            raise Exception('Image dimensions or scale were not specified in any way')
+        size = numpy.stack([numpy.rint(numpy.abs(width) / scale),
+                            numpy.rint(numpy.abs(height) / scale)], axis=1)
+    else:
+        if (sizes.sum(axis=1) <= 0).any():
+            raise Exception('Both dimensions are less or equal to zero')
+        size = sizes.copy()
+        if rotate:
+            # rotate image to fit bbox better
+            swap = (height > width) & ((size[:, 0] == 0) | (size[:, 0] > size[:, 1]))
+            size[swap] = size[swap][:, ::-1]
+        zero_w = size[:, 0] == 0
+        zero_h = ~zero_w & (size[:, 1] == 0)
+        size[zero_w, 0] = numpy.rint(size[zero_w, 1] * width[zero_w] / height[zero_w])
+        size[zero_h, 1] = numpy.rint(size[zero_h, 0] / width[zero_h] * height[zero_h])
+    return bbox, scale, size.astype(int)
+
+
+def plan_batch_scalar(count, sizes, zooms, scales, centers, bboxes, scale_factor, projection,
+                      rotate):
+    """Run plan_map() for each map of plan_batch()"""
+    import numpy
+    proj_target = get_projection(projection)
+    options = create_parser().parse_args(['-'])
+    options.fmt = 'png'
+    options.factor = scale_factor
+    options.projection = projection
+    options.norotate = not rotate
+    bbox = numpy.zeros((count, 4))
+    scale = numpy.full(count, numpy.nan)
+    size = numpy.zeros((count, 2), dtype=int)
+    for i in range(count):
+        options.size_px = None if sizes is None else [int(v) for v in sizes[i]]
+        options.zoom = None if zooms is None else zooms[i]
+        options.scale = None if scales is None else scales[i]
+        options.center = None if centers is None else list(centers[i])
+        options.bbox = None if bboxes is None else list(bboxes[i])
+        plan = plan_map(options, None, proj_target)
+        bbox[i] = box_tuple(plan.bbox)
+        if plan.scale:
+            scale[i] = plan.scale
+        size[i] = plan.size
+    return bbox, scale, size
+
+
+def run(options, maps=None, stream=None):
+    """Render a map with given options.
+
+    maps is an optional dict for reusing loaded styles between calls,
+    see load_style(). When output is '-', the image is written to stream,
+    or to stdout if it is None.
+    """
+    profiler = Profiler()
+
+    # register non-standard fonts
+    if options.fonts:
+        for f in options.fonts:
+            add_fonts(f)
+
+    if options.ozi and not is_web_mercator(options.projection):
+        raise Exception('Ozi map file output is only supported for Web Mercator (EPSG:3857). ' +
+                        'Please remove --projection.')
+
+    # output projection
+    proj_target = get_projection(options.projection)
+    transform = mapnik.ProjTransform(get_projection(EPSG_4326), proj_target)
+
+    profiler.lap('setup')
+    m, style_xml, style_path, buffer_size = load_style(options, proj_target, maps)
+    profiler.lap('load_style')
+
+    extent = None
+    if options.fit:
+        extent = layer_bbox(m, options.fit.split(','), proj_target, None, options.cache_dir)
+    profiler.lap('extent')
+
+    fmt, bbox, size, scale, scale_factor = plan_map(options, m, proj_target, extent)
+    need_cairo = fmt in ['svg', 'pdf']
+    if options.strips and not fmt.startswith('png'):
+        raise Exception('--strips works only for PNG output')
+    if options.just_tiles and fmt in GEOTIFF_FORMATS:
+        raise Exception('--just-tiles is not supported for GeoTIFF output, use -f tiff')
+    if options.palette and (options.strips or not uses_palette(fmt)):
+        raise Exception('--palette works only for PNG output without --strips')
+    if options.tiles == 'auto' and not need_cairo:
+        options.tiles_x, options.tiles_y, memory = plan_tile_grid(size, fmt, options)
+        logging.info('Rendering %sx%s pixels in %sx%s tiles with %s processes, '
+                     'using about %s MB of memory', size[0], size[1], options.tiles_x,
+                     options.tiles_y, options.jobs or multiprocessing.cpu_count(),
+                     memory // 1024**2)
+    profiler.lap('plan')
+
+    if ((options.output == '-' and options.just_tiles) or
+            (need_cairo and (options.tiles_x > 1 or options.tiles_y > 1))):
         options.tiles_x = 1
         options.tiles_y = 1
     max_img_size = max(size[0] / options.tiles_x, size[1] / options.tiles_y)
@@ -476,13 +1923,6 @@ def run(options):
         raise Exception('Image size exceeds mapnik limit ({} > {}), use {}--tiles'.format(
            max_img_size, 16384, larger_part))
 
-    # add / remove some layers
-    if options.layers:
-        filter_layers(m, parse_layers_string(options.layers))
-    if options.add_layers or options.hide_layers:
-        select_layers(m, parse_layers_string(options.add_layers),
-                      parse_layers_string(options.hide_layers))
-
     logging.debug('scale=%s', scale)
     logging.debug('scale_factor=%s', scale_factor)
     logging.debug('size=%s,%s', size[0], size[1])
@@ -492,107 +1932,1286 @@ def run(options):
 
     # export image
     m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+    m.buffer_size = buffer_size
+    palette = None
+    if options.palette:
+        palette = palette_colors(options.palette, m, palette_windows(bbox, size),
+                                 scale_factor, fmt)
+        profiler.lap('palette')
     m.resize(size[0], size[1])
     m.zoom_to_box(bbox)
     logging.debug('m.envelope(): {}'.format(m.envelope()))
 
+    if options.profile_layers:
+        total, layers = profile_layers(m, size, scale_factor, options.profile_layers_mode)
+        print_layer_profile(total, layers, options.profile_layers_mode)
+        return
+
     outfile = options.output
     if options.output == '-':
-        outfile = tempfile.TemporaryFile(mode='w+b')
-
-    if need_cairo:
-        if HAS_CAIRO:
+        outfile = io.BytesIO()
+
+    cache_key = None
+    cached_bbox = None
+    if options.cache_dir and not options.just_tiles:
+        cache_key = render_cache_key(style_xml, style_path, m, size, scale_factor, fmt,
+                                     (options.tiles_x, options.tiles_y), options.strips,
+                                     palette)
+        cached_bbox = cache_get(options.cache_dir, cache_key, outfile)
+        profiler.lap('cache_lookup')
+
+    meta_bbox = cached_bbox
+    if cached_bbox:
+        logging.debug('cache hit: %s', cache_key)
+    elif need_cairo:
+        if has_cairo():
             if fmt == 'svg':
                 surface = cairo.SVGSurface(outfile, size[0], size[1])
             else:
                 surface = cairo.PDFSurface(outfile, size[0], size[1])
             mapnik.render(m, surface, scale_factor, 0, 0)
+            profiler.lap('render')
             surface.finish()
+            profiler.lap('encode')
+        elif options.output == '-':
+            # mapnik can only write svg and pdf to a file
+            with tempfile.NamedTemporaryFile(suffix='.' + fmt) as tmp:
+                mapnik.render_to_file(m, tmp.name, fmt)
+                shutil.copyfileobj(tmp, outfile)
+            profiler.lap('render')
         else:
             mapnik.render_to_file(m, outfile, fmt)
-        write_metadata(m.envelope(), size[0], size[1], transform, options.output,
-                       options.wld, options.ozi)
+            profiler.lap('render')
+        meta_bbox = m.envelope()
     else:
-        if options.tiles_x == options.tiles_y == 1:
+        geotiff = fmt in GEOTIFF_FORMATS
+        if options.tiles_x == options.tiles_y == 1 and not geotiff:
             im = mapnik.Image(size[0], size[1])
             mapnik.render(m, im, scale_factor)
-            im.save(outfile, fmt)
-            write_metadata(m.envelope(), size[0], size[1], transform, options.output,
-                           options.wld, options.ozi)
+            profiler.lap('render')
+            save_image(im, outfile, fmt, palette)
+            profiler.lap('encode')
+            profiler.tile((0, 0, 0), render=profiler.phases[-2]['wall'],
+                          encode=profiler.phases[-1]['wall'])
+            meta_bbox = m.envelope()
         else:
-            # we cannot make mapnik calculate scale for us, so fixing aspect ratio outselves
-            rdiff = (bbox.maxx-bbox.minx) / (bbox.maxy-bbox.miny) - size[0] / size[1]
-            if rdiff > 0:
-                bbox.height((bbox.maxx - bbox.minx) * size[1] / size[0])
-            elif rdiff < 0:
-                bbox.width((bbox.maxy - bbox.miny) * size[0] / size[1])
-            scale = (bbox.maxx - bbox.minx) / size[0]
+            fix_aspect(bbox, size)
             width = max(32, int(math.ceil(1.0 * size[0] / options.tiles_x)))
             height = max(32, int(math.ceil(1.0 * size[1] / options.tiles_y)))
-            m.resize(width, height)
+            if geotiff:
+                # rendered tiles should consist of whole tiff tiles
+                width = int(math.ceil(1.0 * width / GEOTIFF_TILE)) * GEOTIFF_TILE
+                height = int(math.ceil(1.0 * height / GEOTIFF_TILE)) * GEOTIFF_TILE
             m.buffer_size = TILE_BUFFER
-            tile_cnt = [int(math.ceil(1.0 * size[0] / width)),
-                        int(math.ceil(1.0 * size[1] / height))]
+            tiles = tile_grid(bbox, size, width, height)
+            tile_cnt = [tiles[-1][1] + 1, tiles[-1][0] + 1]
             logging.debug('tile_count=%s %s', tile_cnt[0], tile_cnt[1])
             logging.debug('tile_size=%s,%s', width, height)
-            tmp_tile = '{:02d}_{:02d}_{}'
-            tile_files = []
-            for row in range(0, tile_cnt[1]):
-                for column in range(0, tile_cnt[0]):
-                    logging.debug('tile=%s,%s', row, column)
-                    tile_bbox = mapnik.Box2d(
-                        bbox.minx + 1.0 * width * scale * column,
-                        bbox.maxy - 1.0 * height * scale * row,
-                        bbox.minx + 1.0 * width * scale * (column + 1),
-                        bbox.maxy - 1.0 * height * scale * (row + 1))
-                    tile_size = [
-                        width if column < tile_cnt[0] - 1 else size[0] - width * (tile_cnt[0] - 1),
-                        height if row < tile_cnt[1] - 1 else size[1] - height * (tile_cnt[1] - 1)]
-                    m.zoom_to_box(tile_bbox)
-                    im = mapnik.Image(tile_size[0], tile_size[1])
-                    mapnik.render(m, im, scale_factor)
-                    tile_name = tmp_tile.format(row, column, options.output)
-                    im.save(tile_name, fmt)
-                    if options.just_tiles:
-                        # write ozi/wld for a tile if needed
-                        if '.' not in tile_name:
-                            tile_basename = tile_name + '.'
-                        else:
-                            tile_basename = tile_name[0:tile_name.rindex('.')+1]
-                        if options.ozi:
-                            with open(tile_basename + 'ozi', 'w') as f:
-                                f.write(prepare_ozi(tile_bbox, tile_size[0], tile_size[1],
-                                                    tile_basename + '.ozi', transform))
-                        if options.wld:
-                            with open(tile_basename + 'wld', 'w') as f:
-                                f.write(prepare_wld(tile_bbox, tile_size[0], tile_size[1]))
-                    else:
-                        tile_files.append(tile_name)
-            if not options.just_tiles:
-                # join tiles and remove them if joining succeeded
-                import subprocess
-                result = subprocess.call([
-                    IM_MONTAGE, '-geometry', '+0+0', '-tile',
-                    '{}x{}'.format(tile_cnt[0], tile_cnt[1])] +
-                    tile_files + [options.output])
-                if result == 0:
-                    for tile in tile_files:
-                        os.remove(tile)
-                    write_metadata(bbox, size[0], size[1], transform, options.output,
-                                   options.wld, options.ozi)
+
+            names = None
+            result = None
+            strips = None
+            if options.just_tiles:
+                tmp_tile = '{:02d}_{:02d}_{}'
+                names = dict(((row, column), tmp_tile.format(row, column, options.output))
+                             for row, column, _, _ in tiles)
+            elif options.strips:
+                strips = PNGStripWriter(outfile, size[0], size[1], tile_cnt[0])
+            elif not geotiff:
+                result = TileJoiner(size[0], size[1])
+
+            extents = None
+            if options.skip_empty:
+                extents = layer_extents(m, proj_target, options.skip_empty_mode == 'features')
+
+            pool = None
+            if options.jobs != 1 and (len(tiles) > 1 or geotiff):
+                pool = create_tile_pool(options.jobs, m, style_xml, style_path, options.fonts,
+                                        extents)
+            writer = None
+            if options.just_tiles and not pool:
+                # tiles are saved in threads, while processes save their own
+                writer = WritePipeline()
+                boxes = dict(((row, column), (tile_bbox, tile_size))
+                             for row, column, tile_bbox, tile_size in tiles)
+
+                def write_tile(row, column, im):
+                    seconds = save_tile(im, names[row, column], fmt, boxes[row, column][0],
+                                        boxes[row, column][1], transform, options.wld,
+                                        options.ozi, palette)
+                    profiler.tile((0, row, column), encode=seconds)
+            profiler.lap('tile_setup')
+            try:
+                if geotiff:
+                    write_geotiff(outfile, m, bbox, size, (width, height), scale_factor, pool,
+                                  proj_target, options.projection, fmt == 'cog', extents,
+                                  profiler)
+                else:
+                    for row, column, im in render_tiles(m, tiles, (width, height), scale_factor,
+                                                        pool, fmt, None if writer else names,
+                                                        extents, profiler, palette=palette):
+                        logging.debug('tile=%s,%s', row, column)
+                        start = time.time()
+                        if writer:
+                            writer.submit(write_tile, row, column, im)
+                        elif strips:
+                            strips.add_tile(row, column, im)
+                        elif result is not None:
+                            result.add_tile(column * width, row * height, im)
+                        profiler.tile((0, row, column), join=time.time() - start)
+            finally:
+                if writer:
+                    writer.close()
+                if pool:
+                    pool.terminate()
+                    pool.join()
+            profiler.lap('tiles')
+
+            if options.just_tiles:
+                if pool:
+                    # without processes, tiles were saved with their metadata
+                    for row, column, tile_bbox, tile_size in tiles:
+                        write_tile_metadata(names[row, column], tile_bbox, tile_size,
+                                            transform, options.wld, options.ozi)
+            else:
+                if strips:
+                    strips.close()
+                elif result is not None:
+                    save_image(result.image(), outfile, fmt, palette)
+                meta_bbox = bbox
+            profiler.lap('encode')
+
+    if meta_bbox:
+        write_metadata(meta_bbox, size[0], size[1], transform, options.output,
+                       options.wld, options.ozi)
+        profiler.lap('metadata')
+        if cache_key and not cached_bbox:
+            logging.debug('cache miss: %s', cache_key)
+            cache_put(options.cache_dir, cache_key, outfile, meta_bbox, options.cache_max_bytes)
+            profiler.lap('cache_store')
 
     if options.output == '-':
-        if sys.platform == "win32":
-            # fix binary output on windows
-            import msvcrt
-            msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+        if stream is None:
+            if sys.platform == "win32":
+                # fix binary output on windows
+                import msvcrt
+                msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+            stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        data = outfile.getbuffer()
+        for pos in range(0, len(data), STREAM_CHUNK):
+            stream.write(data[pos:pos + STREAM_CHUNK])
+        stream.flush()
+        profiler.lap('output')
+
+    if options.profile_json:
+        profiler.info.update({
+            'output': options.output,
+            'format': fmt,
+            'size': size,
+            'tile_count': [options.tiles_x, options.tiles_y],
+            'jobs': options.jobs,
+            'cached': bool(cached_bbox),
+        })
+        profiler.save(options.profile_json)
+
+
+def output_factor(output):
+    """Get N from a name@Nx.ext file name, 1 if there is none"""
+    match = re.search(r'@(\d+(?:\.\d+)?)x(?:\.[^.@/\\]*)?$', output)
+    return float(match.group(1)) if match else 1
+
+
+def output_format(options, output):
+    """Format for one of several outputs: by its extension, or from --format"""
+    if '.' in os.path.basename(output):
+        fmt = output.split('.')[-1].lower()
+        return 'jpeg' if fmt == 'jpg' else fmt
+    return options.fmt.lower() if options.fmt else 'png256'
+
+
+def metadata_files(options, output):
+    """Open world (name.pngw) and ozi (name.png.map) files for an additional output"""
+    return [open(output + suffix, 'w') if f else None
+            for f, suffix in ((options.wld, 'w'), (options.ozi, '.map'))]
+
+
+def encode_output_task(task):
+    """Decode an image in TILE_TRANSFER_FORMAT and save it to a file"""
+    data, output, fmt, palette = task
+    save_image(image_from_string(data), output, fmt, palette)
+    return output
+
+
+def run_outputs(options, maps=None):
+    """Render a map once and save it to options.output and options.outputs.
+
+    Outputs named name@2x.ext are rendered with doubled --factor and size.
+    The image is rendered once for each factor and encoded to every format,
+    in parallel with --jobs. Outputs that cannot be made from one raster image
+    (svg, pdf, GeoTIFF, --tiles) are rendered separately with run().
+    PNG outputs share one --palette. World and ozi files for additional
+    outputs are named after them, see metadata_files().
+    """
+    outputs = [options.output] + options.outputs
+    if '-' in outputs:
+        raise Exception('Cannot write several outputs to stdout')
+    if options.fonts:
+        for f in options.fonts:
+            add_fonts(f)
+    if maps is None:
+        maps = {}
 
-        outfile.seek(0)
-        sys.stdout.write(outfile.read())
-        outfile.close()
+    proj_target = get_projection(options.projection)
+    transform = mapnik.ProjTransform(get_projection(EPSG_4326), proj_target)
+    m, _, _, buffer_size = load_style(options, proj_target, maps)
+    _, bbox, size, _, scale_factor = plan_map(options, m, proj_target)
+    m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+    m.buffer_size = buffer_size
+    palette = None
+    if options.palette:
+        palette = palette_colors(options.palette, m, palette_windows(bbox, size),
+                                 scale_factor, output_format(options, options.output))
+
+    simple = []
+    for output in outputs:
+        fmt = output_format(options, output)
+        factor = output_factor(output)
+        if (fmt in ['svg', 'pdf'] or fmt in GEOTIFF_FORMATS or options.cache_dir
+                or options.tiles == 'auto' or options.tiles_x * options.tiles_y > 1):
+            job_options = copy.copy(options)
+            job_options.output = output
+            job_options.fmt = fmt
+            job_options.fonts = None
+            job_options.palette = palette if uses_palette(fmt) else None
+            if output != options.output:
+                job_options.wld, job_options.ozi = metadata_files(options, output)
+            if factor != 1:
+                if options.ppi:
+                    job_options.ppi = options.ppi * factor
+                else:
+                    job_options.factor = options.factor * factor
+                if options.size_px:
+                    job_options.size_px = [int(round(v * factor)) for v in options.size_px]
+            try:
+                run(job_options, maps)
+            finally:
+                if output != options.output:
+                    for f in (job_options.wld, job_options.ozi):
+                        if f:
+                            f.close()
+        else:
+            simple.append((factor, output, fmt))
+    if not simple:
+        return
+
+    pool = None
+    if options.jobs != 1 and len(simple) > 1:
+        pool = multiprocessing.Pool(options.jobs or None)
+    try:
+        for factor in sorted(set(s[0] for s in simple)):
+            group = [s for s in simple if s[0] == factor]
+            width = int(round(size[0] * factor))
+            height = int(round(size[1] * factor))
+            if max(width, height) > 16384:
+                raise Exception('Image size exceeds mapnik limit ({} > {}), use --tiles'.format(
+                    max(width, height), 16384))
+            m.resize(width, height)
+            m.zoom_to_box(bbox)
+            im = mapnik.Image(width, height)
+            mapnik.render(m, im, scale_factor * factor)
+            logging.debug('rendered %sx%s for %s', width, height, ', '.join(s[1] for s in group))
+            if pool:
+                data = image_to_string(im, TILE_TRANSFER_FORMAT)
+                done = pool.imap_unordered(
+                    encode_output_task,
+                    [(data, output, fmt, palette if uses_palette(fmt) else None)
+                     for _, output, fmt in group])
+            else:
+                done = [save_image(im, output, fmt, palette if uses_palette(fmt) else None)
+                        for _, output, fmt in group]
+            for _ in done:
+                pass
+            for _, output, _ in group:
+                if output == options.output:
+                    files = [options.wld, options.ozi]
+                else:
+                    files = metadata_files(options, output)
+                write_metadata(m.envelope(), width, height, transform, output, *files)
+                if output != options.output:
+                    for f in files:
+                        if f:
+                            f.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+# Options that are fixed when a Renderer loads the style
+STYLE_OPTIONS = ('style', 'base', 'vars', 'layers', 'add_layers', 'hide_layers', 'projection',
+                 'fonts')
+
+
+class Renderer(object):
+    """Render maps from a style loaded once, for using Nik4 as a library.
+
+    Keyword arguments are names of command line options as in run() options
+    (size_px, bbox, center, zoom, fmt, factor and so on). Options from
+    STYLE_OPTIONS can be set only in the constructor, others set there are
+    defaults for each call:
+
+        renderer = nik4.Renderer('osm.xml', size_px=[800, 600])
+        png = renderer.render(center=[24.75, 59.43], zoom=14, fmt='png')
+        pixels = renderer.array(center=[24.75, 59.43], zoom=14)
+    """
+
+    def __init__(self, style, **kwargs):
+        self.options = create_parser().parse_args([style])
+        self.options.output = '-'
+        # the caller knows which size it needs
+        self.options.norotate = True
+        for key, value in kwargs.items():
+            if not hasattr(self.options, key):
+                raise TypeError('Unknown option: ' + key)
+            setattr(self.options, key, value)
+        if self.options.fonts:
+            for f in self.options.fonts:
+                add_fonts(f)
+            self.options.fonts = None
+        self.proj_target = get_projection(self.options.projection)
+        self.maps = MapCache()
+        self.map, _, _, self.buffer_size = load_style(self.options, self.proj_target, self.maps)
+
+    def make_options(self, **kwargs):
+        """Return a copy of renderer options updated with kwargs"""
+        options = copy.copy(self.options)
+        for key, value in kwargs.items():
+            if key in STYLE_OPTIONS:
+                raise ValueError('Option {} can be set only for a new Renderer'.format(key))
+            if not hasattr(options, key):
+                raise TypeError('Unknown option: ' + key)
+            setattr(options, key, value)
+        parse_tiles(options)
+        return options
+
+    def plan(self, **kwargs):
+        """Calculate format, bbox and size for options without rendering, see plan_map()"""
+        return plan_map(self.make_options(**kwargs), self.map, self.proj_target)
+
+    def render(self, **kwargs):
+        """Render a map and return it encoded, the same as run() writes to a file"""
+        stream = io.BytesIO()
+        run(self.make_options(**kwargs), self.maps, stream)
+        return stream.getvalue()
+
+    def image(self, **kwargs):
+        """Render a map into a mapnik.Image without encoding it.
+
+        Tiling options are ignored: the image is rendered in one piece,
+        so it is limited to 16384 pixels on each side.
+        """
+        plan = self.plan(**kwargs)
+        m = self.map
+        m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+        m.buffer_size = self.buffer_size
+        m.resize(plan.size[0], plan.size[1])
+        m.zoom_to_box(plan.bbox)
+        im = mapnik.Image(plan.size[0], plan.size[1])
+        mapnik.render(m, im, plan.scale_factor)
+        if im.premultiplied():
+            im.demultiply()
+        return im
+
+    def buffer(self, **kwargs):
+        """Render a map into bytes of RGBA pixels, row by row from the top"""
+        return image_to_string(self.image(**kwargs))
+
+    def array(self, **kwargs):
+        """Render a map into a NumPy array of shape (height, width, 4).
+
+        The array is a read-only view of buffer() result: pixels are copied once,
+        out of the mapnik image, and not again by NumPy.
+        """
+        import numpy
+        im = self.image(**kwargs)
+        return numpy.frombuffer(image_to_string(im), dtype=numpy.uint8).reshape(
+            (im.height(), im.width(), 4))
+
+
+def tile_extension(fmt):
+    """File extension for tiles of a mapnik format"""
+    if fmt.startswith('jpeg') or fmt.startswith('jpg'):
+        return 'jpg'
+    match = re.match(r'[a-z]+', fmt)
+    return match.group(0) if match else fmt
+
+
+class MBTilesWriter(object):
+    """Store tiles in an MBTiles SQLite database, inserting them in batches"""
+
+    def __init__(self, path, metadata, batch_size=1000):
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        self.db.execute('create table if not exists metadata (name text, value text)')
+        self.db.execute('create table if not exists tiles (zoom_level integer, '
+                        'tile_column integer, tile_row integer, tile_data blob)')
+        self.db.execute('create unique index if not exists tile_index '
+                        'on tiles (zoom_level, tile_column, tile_row)')
+        self.db.execute('delete from metadata')
+        self.db.executemany('insert into metadata (name, value) values (?, ?)',
+                            sorted(metadata.items()))
+        self.batch_size = batch_size
+        self.batch = []
+
+    def add_tiles(self, tiles):
+        for z, x, y, data in tiles:
+            # mbtiles use TMS numbering of rows
+            self.batch.append((z, x, 2**z - 1 - y, data))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.db.executemany('insert or replace into tiles (zoom_level, tile_column, '
+                                'tile_row, tile_data) values (?, ?, ?, ?)', self.batch)
+            self.db.commit()
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class TileDirWriter(object):
+    """Store tiles in a z/x/y directory structure"""
+
+    def __init__(self, path, ext):
+        self.path = path
+        self.ext = ext
+
+    def add_tiles(self, tiles):
+        for z, x, y, data in tiles:
+            tile_dir = os.path.join(self.path, str(z), str(x))
+            if not os.path.isdir(tile_dir):
+                os.makedirs(tile_dir)
+            with open(os.path.join(tile_dir, '{}.{}'.format(y, self.ext)), 'wb') as f:
+                f.write(data)
+
+    def close(self):
+        pass
+
+
+def render_metatile(m, metatile, tile_px, scale_factor, fmt, palette=None):
+    """Render a metatile and slice it into web mercator tiles.
+
+    metatile is a tuple of (zoom, x, y, columns, rows, tiles), where x and y
+    are numbers of the top left tile, and tiles is a list of (x, y) to keep.
+    Tiles are encoded in fmt with palette. Returns a list of (zoom, x, y, data).
+    """
+    zoom, x, y, columns, rows, wanted = metatile
+    tile_m = 2 * MERC_MAX / 2**zoom
+    m.resize(columns * tile_px, rows * tile_px)
+    m.zoom_to_box(mapnik.Box2d(-MERC_MAX + x * tile_m, MERC_MAX - (y + rows) * tile_m,
+                               -MERC_MAX + (x + columns) * tile_m, MERC_MAX - y * tile_m))
+    im = mapnik.Image(columns * tile_px, rows * tile_px)
+    mapnik.render(m, im, scale_factor)
+    return [(zoom, tx, ty, image_to_string(
+             im.view((tx - x) * tile_px, (ty - y) * tile_px, tile_px, tile_px), fmt, palette))
+            for tx, ty in wanted]
 
 
-if __name__ == "__main__":
+def render_metatile_task(task):
+    """Render a metatile in a worker process, see render_metatile()"""
+    return render_metatile(_worker_map, *task)
+
+
+def pyramid_metatiles(bbox, zooms, size):
+    """Group web mercator tiles covering bbox on given zooms into metatiles of size×size.
+
+    Yields tuples for render_metatile().
+    """
+    for zoom in zooms:
+        count = 2**zoom
+        tile_m = 2 * MERC_MAX / count
+
+        def tile_range(low, high):
+            return (max(0, min(count - 1, int(math.floor(low / tile_m)))),
+                    max(0, min(count - 1, int(math.ceil(high / tile_m)) - 1)))
+
+        x1, x2 = tile_range(bbox.minx + MERC_MAX, bbox.maxx + MERC_MAX)
+        y1, y2 = tile_range(MERC_MAX - bbox.maxy, MERC_MAX - bbox.miny)
+        for my in range(y1 // size, y2 // size + 1):
+            for mx in range(x1 // size, x2 // size + 1):
+                x = mx * size
+                y = my * size
+                wanted = [(tx, ty) for ty in range(max(y, y1), min(y + size - 1, y2) + 1)
+                          for tx in range(max(x, x1), min(x + size - 1, x2) + 1)]
+                yield (zoom, x, y, min(size, count - x), min(size, count - y), wanted)
+
+
+def parse_pyramid(value):
+    """Parse a zoom level or a range of them for --pyramid into a range"""
+    match = re.match(r'^(\d+)(?:-(\d+))?$', value)
+    if not match or int(match.group(1)) > int(match.group(2) or match.group(1)):
+        raise argparse.ArgumentTypeError(
+            'Pyramid needs a zoom level or an increasing range, e.g. 10-14')
+    return range(int(match.group(1)), int(match.group(2) or match.group(1)) + 1)
+
+
+def positive_int(value):
+    """Parse an integer that is at least 1"""
+    if not re.match(r'^\d+$', value) or int(value) < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return int(value)
+
+
+def run_pyramid(options, maps=None):
+    """Render web mercator tiles for zoom levels in options.pyramid, a range"""
+    zooms = options.pyramid
+    fmt = options.fmt.lower() if options.fmt else 'png256'
+    scale_factor = options.factor
+    tile_px = int(round(256 * scale_factor))
+
+    proj_target = get_projection(EPSG_3857)
+    m, style_xml, style_path, buffer_size = load_style(options, proj_target, maps)
+    bbox = None
+    if options.bbox:
+        bbox = lonlat_webmerc().forward(mapnik.Box2d(*options.bbox))
+    if options.fit:
+        bbox = layer_bbox(m, options.fit.split(','), proj_target, bbox, options.cache_dir)
+    if not bbox:
+        raise Exception('Bounding box was not specified in any way')
+    m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+    m.buffer_size = TILE_BUFFER
+    palette = None
+    if options.palette:
+        if not uses_palette(fmt):
+            raise Exception('--palette works only for PNG tiles')
+        # sample the lowest, the middle and the highest zoom levels
+        windows = []
+        for zoom in sorted(set([zooms[0], zooms[len(zooms) // 2], zooms[-1]])):
+            px = tile_px * 2**zoom / (2 * MERC_MAX)
+            windows.extend(palette_windows(bbox, ((bbox.maxx - bbox.minx) * px,
+                                                  (bbox.maxy - bbox.miny) * px), count=2))
+        palette = palette_colors(options.palette, m, windows, scale_factor, fmt)
+    metatiles = list(pyramid_metatiles(bbox, zooms, options.metatile))
+    logging.debug('bbox=%s', bbox)
+    logging.debug('metatiles=%s tiles=%s', len(metatiles), sum(len(t[5]) for t in metatiles))
+
+    if options.output.endswith('.mbtiles'):
+        bounds = lonlat_webmerc().backward(bbox)
+        writer = MBTilesWriter(options.output, {
+            'name': os.path.splitext(os.path.basename(options.output))[0],
+            'format': tile_extension(fmt),
+            'type': 'baselayer',
+            'bounds': '{},{},{},{}'.format(max(-180, bounds.minx), max(-85.0511, bounds.miny),
+                                           min(180, bounds.maxx), min(85.0511, bounds.maxy)),
+            'minzoom': str(zooms[0]),
+            'maxzoom': str(zooms[-1]),
+        })
+    else:
+        writer = TileDirWriter(options.output, tile_extension(fmt))
+
+    pool = None
+    if options.jobs != 1 and len(metatiles) > 1:
+        pool = create_tile_pool(options.jobs, m, style_xml, style_path, options.fonts)
+    try:
+        tasks = [(metatile, tile_px, scale_factor, fmt, palette) for metatile in metatiles]
+        if pool:
+            results = pool.imap_unordered(render_metatile_task, tasks)
+        else:
+            results = (render_metatile(m, *task) for task in tasks)
+        for tiles in results:
+            logging.debug('metatile=%s/%s/%s', *tiles[0][:3])
+            writer.add_tiles(tiles)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        writer.close()
+
+
+def atlas_pages(bbox, page_size, overlap):
+    """Split bbox into a grid of pages of page_size, overlapping by overlap.
+
+    Sizes are in the bbox units. The grid is centered on the bbox. Returns
+    a list of mapnik.Box2d, row by row from the top left page.
+    """
+    counts = []
+    for extent, page in zip((bbox.maxx - bbox.minx, bbox.maxy - bbox.miny), page_size):
+        step = page - overlap
+        if step <= 0:
+            raise Exception('Page overlap should be less than the page size')
+        counts.append(max(1, int(math.ceil((extent - page) / step - 1e-9)) + 1))
+    step_x = page_size[0] - overlap
+    step_y = page_size[1] - overlap
+    left = (bbox.minx + bbox.maxx - page_size[0] - (counts[0] - 1) * step_x) / 2
+    top = (bbox.miny + bbox.maxy + page_size[1] + (counts[1] - 1) * step_y) / 2
+    pages = []
+    for row in range(counts[1]):
+        for column in range(counts[0]):
+            minx = left + column * step_x
+            maxy = top - row * step_y
+            pages.append(mapnik.Box2d(minx, maxy - page_size[1], minx + page_size[0], maxy))
+    return pages
+
+
+def run_atlas(options, maps=None):
+    """Render a bbox or --fit extent as a multi-page PDF of --paper sized pages.
+
+    All pages are rendered from one loaded map into one cairo surface, so fonts
+    and symbols are embedded in the file once.
+    """
+    if not has_cairo():
+        raise Exception('--atlas needs pycairo')
+    if options.fonts:
+        for f in options.fonts:
+            add_fonts(f)
+    proj_target = get_projection(options.projection)
+    m, _, _, buffer_size = load_style(options, proj_target, maps)
+    fmt, bbox, size, scale, scale_factor = plan_map(options, m, proj_target)
+    if fmt != 'pdf':
+        raise Exception('--atlas works only for PDF output')
+    if not scale:
+        raise Exception('--atlas needs a scale, use --zoom or --scale')
+    if not options.paper and not options.size and not options.size_px:
+        raise Exception('--atlas needs a page size, use --paper or --size')
+
+    # overlap is in millimeters, like margins and padding
+    overlap = options.overlap * 90.7 / 25.4 * scale_factor * scale
+    pages = atlas_pages(bbox, (size[0] * scale, size[1] * scale), overlap)
+    logging.info('Rendering %s pages of %sx%s pixels', len(pages), size[0], size[1])
+
+    m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+    m.buffer_size = buffer_size
+    m.resize(size[0], size[1])
+    surface = cairo.PDFSurface(options.output, size[0], size[1])
+    try:
+        for page_no, page in enumerate(pages, 1):
+            logging.debug('page=%s bbox=%s', page_no, page)
+            m.zoom_to_box(page)
+            mapnik.render(m, surface, scale_factor, 0, 0)
+            surface.show_page()
+    finally:
+        surface.finish()
+
+
+def feature_index(layer):
+    """Map fingerprints of geometry and attributes of layer features to their boxes"""
+    index = {}
+    query = mapnik.Query(layer.envelope())
+    for name in layer.datasource.fields():
+        query.add_property_name(name)
+    for f in layer.datasource.features(query):
+        h = hashlib.sha1(f.geometry.to_wkb(mapnik.wkbByteOrder.NDR))
+        h.update(repr(sorted(f.attributes.items())).encode('utf-8'))
+        index[h.hexdigest()] = box_tuple(f.envelope())
+    return index
+
+
+def file_stamps(files):
+    """Modification times and sizes of files, for noticing changes"""
+    stamps = []
+    for name in files:
+        try:
+            stamps.append((name, os.path.getmtime(name), os.path.getsize(name)))
+        except OSError:
+            stamps.append((name, None, None))
+    return stamps
+
+
+def feature_index_task(name):
+    """Make feature_index() of a layer of the worker map"""
+    for layer in _worker_map.layers:
+        if layer.name == name:
+            return name, feature_index(layer)
+
+
+def run_watch(options):
+    """Render a tiled image, then re-render tiles when the style or data change.
+
+    Polls the style file and files of layer datasources every
+    options.watch_interval seconds. A changed style is loaded and rendered
+    again. When data files change, only tiles that meet added or removed
+    features are rendered, and the image and its world and ozi files are
+    rewritten. Runs until interrupted.
+    """
+    if options.output == '-' or options.style == '-':
+        raise Exception('--watch needs style and output files')
+    if options.fonts:
+        for f in options.fonts:
+            add_fonts(f)
+    proj_target = get_projection(options.projection)
+    transform = mapnik.ProjTransform(get_projection(EPSG_4326), proj_target)
+    # some datasources (CSV, GeoJSON) keep file contents for the lifetime of
+    # a process, so data is read and rendered only in new processes
+    context = multiprocessing.get_context('spawn')
+
+    def start_pool(m, style_xml, style_path):
+        active = [l.name for l in m.layers if l.active]
+        return context.Pool(options.jobs or None, initializer=init_tile_worker,
+                            initargs=(style_xml, style_path, m.srs, active, options.fonts))
+
+    def save(result, fmt, bbox, size):
+        save_image(result.image(), options.output, fmt)
+        for f in (options.wld, options.ozi):
+            if f:
+                f.seek(0)
+                f.truncate()
+        write_metadata(bbox, size[0], size[1], transform, options.output,
+                       options.wld, options.ozi)
+        for f in (options.wld, options.ozi):
+            if f:
+                f.flush()
+
+    try:
+        while True:
+            start = time.time()
+            style_stamp = file_stamps([options.style])
+            m, style_xml, style_path, _ = load_style(options, proj_target)
+            fmt, bbox, size, scale, scale_factor = plan_map(options, m, proj_target)
+            if fmt in ['svg', 'pdf'] or fmt in GEOTIFF_FORMATS:
+                raise Exception('--watch works only for raster images')
+            fix_aspect(bbox, size)
+            if options.tiles_x * options.tiles_y > 1:
+                tile_size = (max(32, int(math.ceil(1.0 * size[0] / options.tiles_x))),
+                             max(32, int(math.ceil(1.0 * size[1] / options.tiles_y))))
+            else:
+                tile_size = (WATCH_TILE, WATCH_TILE)
+            tiles = tile_grid(bbox, size, tile_size[0], tile_size[1])
+            layers = dict((l.name, l) for l in m.layers if l.active and layer_files(l))
+            stamps = dict((name, file_stamps(layer_files(l))) for name, l in layers.items())
+            result = TileJoiner(size[0], size[1])
+            pool = start_pool(m, style_xml, style_path)
+            try:
+                indexes = dict(pool.map(feature_index_task, list(layers)))
+                for row, column, im in render_tiles(m, tiles, tile_size, scale_factor, pool):
+                    result.add_tile(column * tile_size[0], row * tile_size[1], im)
+            finally:
+                pool.terminate()
+                pool.join()
+            save(result, fmt, bbox, size)
+            logging.info('Rendered %s tiles in %.2f s, watching for changes', len(tiles),
+                         time.time() - start)
+
+            while file_stamps([options.style]) == style_stamp:
+                time.sleep(options.watch_interval)
+                changed = [name for name, l in layers.items()
+                           if file_stamps(layer_files(l)) != stamps[name]]
+                if not changed:
+                    continue
+                start = time.time()
+                # symbols reach as far as the tile buffer from features
+                pad = TILE_BUFFER * (bbox.maxx - bbox.minx) / size[0]
+                dirty = []
+                dirty_tiles = []
+                pool = start_pool(m, style_xml, style_path)
+                try:
+                    for name, index in pool.map(feature_index_task, changed):
+                        stamps[name] = file_stamps(layer_files(layers[name]))
+                        box_trans = mapnik.ProjTransform(
+                            mapnik.Projection(layers[name].srs), proj_target)
+                        for key in set(index) ^ set(indexes[name]):
+                            box = index.get(key, indexes[name].get(key))
+                            box = box_trans.forward(mapnik.Box2d(*box))
+                            dirty.append((box.minx - pad, box.miny - pad,
+                                          box.maxx + pad, box.maxy + pad))
+                        indexes[name] = index
+                    dirty_tiles = [t for t in tiles if boxes_intersect(box_tuple(t[2]), dirty)]
+                    for row, column, im in render_tiles(m, dirty_tiles, tile_size, scale_factor,
+                                                        pool):
+                        result.add_tile(column * tile_size[0], row * tile_size[1], im)
+                finally:
+                    pool.terminate()
+                    pool.join()
+                if dirty_tiles:
+                    save(result, fmt, bbox, size)
+                logging.info('%s changed: rendered %s of %s tiles in %.2f s',
+                             ', '.join(changed), len(dirty_tiles), len(tiles),
+                             time.time() - start)
+            logging.info('Style changed, loading it again')
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_shard(value):
+    """Parse K/N for --shard into a tuple"""
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if not match or not 0 < int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError('Shard should be K/N with 0 < K ≤ N, e.g. 2/4')
+    return int(match.group(1)), int(match.group(2))
+
+
+def run_shard(options, maps=None):
+    """Render every N-th tile of the --tiles grid, starting from K-th, into a directory.
+
+    Tiles are saved in TILE_TRANSFER_FORMAT and listed with their positions
+    in a manifest, which is written after all of them, so that merge() sees
+    only finished shards. Running the same command with every K from 1 to N,
+    on one machine or several machines sharing options.output, renders the
+    whole image.
+    """
+    shard, shards = options.shard
+    if options.tiles == 'auto':
+        raise Exception('--shard needs a fixed --tiles grid, the same for all shards')
+    if options.output == '-':
+        raise Exception('--shard needs a directory for output')
+    if options.fonts:
+        for f in options.fonts:
+            add_fonts(f)
+    proj_target = get_projection(options.projection)
+    m, style_xml, style_path, _ = load_style(options, proj_target, maps)
+    _, bbox, size, _, scale_factor = plan_map(options, m, proj_target)
+    fix_aspect(bbox, size)
+    width = max(32, int(math.ceil(1.0 * size[0] / options.tiles_x)))
+    height = max(32, int(math.ceil(1.0 * size[1] / options.tiles_y)))
+    if max(width, height) > 16384:
+        raise Exception('Tile size exceeds mapnik limit ({} > {}), use a larger value for '
+                        '--tiles'.format(max(width, height), 16384))
+    m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+    m.buffer_size = TILE_BUFFER
+    tiles = tile_grid(bbox, size, width, height)
+    grid = [tiles[-1][1] + 1, tiles[-1][0] + 1]
+    tiles = tiles[shard - 1::shards]
+    logging.info('Rendering %s of %s tiles for shard %s/%s', len(tiles), grid[0] * grid[1],
+                 shard, shards)
+
+    # other shards can be creating it at the same time
+    os.makedirs(options.output, exist_ok=True)
+    names = dict(((row, column), os.path.join(options.output, SHARD_TILE.format(row, column)))
+                 for row, column, _, _ in tiles)
+    extents = None
+    if options.skip_empty:
+        extents = layer_extents(m, proj_target, options.skip_empty_mode == 'features')
+    pool = None
+    if options.jobs != 1 and len(tiles) > 1:
+        pool = create_tile_pool(options.jobs, m, style_xml, style_path, options.fonts, extents)
+    try:
+        for row, column, _ in render_tiles(m, tiles, (width, height), scale_factor, pool,
+                                           TILE_TRANSFER_FORMAT, names, extents):
+            logging.debug('tile=%s,%s', row, column)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    manifest = {
+        'schema': SHARD_SCHEMA,
+        'version': VERSION,
+        'shard': shard,
+        'shards': shards,
+        'projection': options.projection,
+        'bbox': box_tuple(bbox),
+        'size': list(size),
+        'grid': grid,
+        'tiles': [{'row': row, 'column': column, 'x': column * width, 'y': row * height,
+                   'size': list(tile_size), 'bbox': box_tuple(tile_bbox),
+                   'file': os.path.basename(names[row, column])}
+                  for row, column, tile_bbox, tile_size in tiles],
+    }
+    manifest_file = os.path.join(options.output, SHARD_MANIFEST.format(shard, shards))
+    tmp_file = '{}.{}'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def read_shards(directory):
+    """Read and check manifests of all shards in a directory, return them sorted"""
+    manifests = []
+    for name in sorted(os.listdir(directory)):
+        if re.match(r'^shard-\d+-of-\d+\.json$', name):
+            with open(os.path.join(directory, name), 'r') as f:
+                manifests.append(json.load(f))
+    if not manifests:
+        raise Exception('No shard manifests in ' + directory)
+    manifests.sort(key=lambda s: (s['shards'], s['shard']))
+    first = manifests[0]
+    for manifest in manifests:
+        if manifest.get('schema') != SHARD_SCHEMA:
+            raise Exception('Shard {} has unknown schema {}'.format(
+                manifest['shard'], manifest.get('schema')))
+        for key in ('shards', 'projection', 'bbox', 'size', 'grid'):
+            if manifest[key] != first[key]:
+                raise Exception('Shards were rendered with different options: {} {} != {}'.format(
+                    key, manifest[key], first[key]))
+    missing = sorted(set(range(1, first['shards'] + 1)) - set(s['shard'] for s in manifests))
+    if missing:
+        raise Exception('Missing shards: {} of {}'.format(
+            ', '.join(str(k) for k in missing), first['shards']))
+    return manifests
+
+
+def merge(args):
+    """Join shards rendered with --shard: nik4.py merge [options] directory output"""
+    parser = argparse.ArgumentParser(
+        prog='nik4.py merge',
+        description='Nik4 {}: join tiles rendered with --shard into an image'.format(VERSION))
+    parser.add_argument('-f', '--format', dest='fmt',
+                        help='Target file format (by default looks at extension)')
+    parser.add_argument('--ozi', type=argparse.FileType('w'), help='Generate ozi map file')
+    parser.add_argument('--wld', type=argparse.FileType('w'), help='Generate world file')
+    parser.add_argument('--strips', action='store_true', default=False,
+                        help='Write a 32-bit PNG row by row, keeping only one row of tiles '
+                        'in memory')
+    parser.add_argument('-v', '--debug', action='store_true', default=False,
+                        help='Display calculated values')
+    parser.add_argument('directory', help='Directory with shards')
+    parser.add_argument('output', help='Resulting image')
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+
+    manifests = read_shards(options.directory)
+    first = manifests[0]
+    size = first['size']
+    if options.ozi and not is_web_mercator(first['projection']):
+        raise Exception('Ozi map file output is only supported for Web Mercator (EPSG:3857). ' +
+                        'Shards were rendered in ' + first['projection'])
+    fmt = output_format(options, options.output)
+    if fmt in ['svg', 'pdf'] or fmt in GEOTIFF_FORMATS:
+        raise Exception('Shards can be merged only into a raster image, not ' + fmt)
+    if options.strips and not fmt.startswith('png'):
+        raise Exception('--strips works only for PNG output')
+    tiles = sorted([t for s in manifests for t in s['tiles']],
+                   key=lambda t: (t['row'], t['column']))
+    if len(tiles) != first['grid'][0] * first['grid'][1]:
+        raise Exception('Shards have {} tiles instead of {}'.format(
+            len(tiles), first['grid'][0] * first['grid'][1]))
+
+    strips = None
+    result = None
+    if options.strips:
+        strips = PNGStripWriter(options.output, size[0], size[1], first['grid'][0])
+    else:
+        result = TileJoiner(size[0], size[1])
+    for tile in tiles:
+        logging.debug('tile=%s,%s', tile['row'], tile['column'])
+        im = mapnik.Image.open(os.path.join(options.directory, tile['file']))
+        if strips:
+            strips.add_tile(tile['row'], tile['column'], im)
+        else:
+            result.add_tile(tile['x'], tile['y'], im)
+    if strips:
+        strips.close()
+    else:
+        save_image(result.image(), options.output, fmt)
+
+    transform = mapnik.ProjTransform(get_projection(EPSG_4326),
+                                     get_projection(first['projection']))
+    write_metadata(mapnik.Box2d(*first['bbox']), size[0], size[1], transform, options.output,
+                   options.wld, options.ozi)
+
+
+def parse_tiles(options):
+    """Fill tiles_x and tiles_y from the --tiles option"""
+    options.tiles_x = 0
+    options.tiles_y = 0
+
+    if options.tiles == 'auto':
+        # chosen by plan_tile_grid() when the image size is known
+        options.tiles_x = 1
+        options.tiles_y = 1
+    elif options.tiles:
+        if str(options.tiles).isdigit():
+            options.tiles_x = int(options.tiles)
+            options.tiles_y = options.tiles_x
+        else:
+            match = re.search(r'^(\d+)x(\d+)$', options.tiles)
+            if match:
+                options.tiles_x = int(match.group(1))
+                options.tiles_y = int(match.group(2))
+        # joining tiles in memory needs the whole image there
+        max_tiles = None if options.strips else 144
+        if options.tiles_x < 1 or options.tiles_y < 1 or (
+                max_tiles and options.tiles_x * options.tiles_y > max_tiles):
+            raise Exception('--tiles needs positive integer argument, or two integers separated '
+                            'by x; max. number of tiles is 144 (unlimited with --strips)')
+
+
+# options of other modes than run(), which batch jobs cannot use
+BATCH_UNSUPPORTED = ('outputs', 'pyramid', 'metatile', 'atlas', 'overlap', 'watch',
+                     'watch_interval', 'shard')
+
+
+def batch_job_options(options, job):
+    """Make options for a batch job from command-line options and a manifest entry.
+
+    World and ozi files are left as paths, see open_job_files().
+    """
+    job_options = copy.copy(options)
+    job_options.batch = None
+    job_options.fonts = None  # registered once for the batch
+    job_options.wld = None
+    job_options.ozi = None
+    for key, value in job.items():
+        key = key.replace('-', '_')
+        if key == 'format':
+            key = 'fmt'
+        if key in ('wld', 'ozi'):
+            value = value or None
+        elif key not in vars(options) or key in ('tiles_x', 'tiles_y', 'batch', 'fonts'):
+            raise Exception('Unknown option in batch job: {}'.format(key))
+        elif key in BATCH_UNSUPPORTED:
+            raise Exception('Option {} is not supported in batch jobs'.format(key))
+        setattr(job_options, key, value)
+    if not job_options.output:
+        raise Exception('Batch job has no output')
+    parse_tiles(job_options)
+    return job_options
+
+
+def open_job_files(job_options):
+    """Replace world and ozi file paths of a batch job with opened files"""
+    for key in ('wld', 'ozi'):
+        path = getattr(job_options, key)
+        if path:
+            setattr(job_options, key, None)
+            setattr(job_options, key, open(path, 'w'))
+
+
+def batch_palette(options, lines, maps):
+    """Resolve --palette once for all jobs of a batch, return RGBA bytes or None.
+
+    'auto' samples up to PALETTE_WINDOWS jobs spread over the manifest, each
+    with its own style and extent. Jobs that set their own palette are skipped.
+    """
+    if not options.palette:
+        return None
+    if options.palette != 'auto':
+        return load_palette(options.palette)
+    views = []
+    fmt = None
+    step = max(1, len(lines) // PALETTE_WINDOWS)
+    for line_no, line in lines[::step][:PALETTE_WINDOWS]:
+        try:
+            job_options = batch_job_options(options, json.loads(line))
+            if job_options.palette != options.palette:
+                continue
+            proj_target = get_projection(job_options.projection)
+            m, style_xml, style_path, buffer_size = load_style(job_options, proj_target, maps)
+            job_fmt, bbox, size, scale, scale_factor = plan_map(job_options, m, proj_target)
+        except Exception as e:
+            logging.debug('Job %s is not sampled for the palette: %s', line_no, e)
+            continue
+        if not uses_palette(job_fmt):
+            continue
+        fmt = fmt or job_fmt
+        m.aspect_fix_mode = mapnik.aspect_fix_mode.GROW_BBOX
+        m.buffer_size = buffer_size
+        views.extend((m, window, scale_factor)
+                     for window in palette_windows(bbox, size, count=2))
+    if not views:
+        return None
+    colors = sample_palette(views, fmt)
+    logging.info('Sampled a palette of %s colors for the batch', len(colors) // 4)
+    return colors
+
+
+def run_batch(options):
+    """Render every job from options.batch manifest, reusing loaded styles.
+
+    Each line of the manifest is a JSON object with options for a job, e.g.
+    {"bbox": [10, 50, 11, 51], "zoom": 12, "output": "a.png", "wld": "a.wld"}.
+    Missing options are taken from the command line, and all jobs share
+    one --palette. Returns True if all jobs succeeded.
+    """
+    if options.fonts:
+        for f in options.fonts:
+            add_fonts(f)
+    maps = MapCache()
+    succeeded = []
+    failed = []
+    if options.batch == '-':
+        manifest = sys.stdin
+    else:
+        manifest = codecs.open(options.batch, 'r', 'utf-8')
+    try:
+        lines = [(line_no, line.strip()) for line_no, line in enumerate(manifest, 1)]
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+    lines = [(line_no, line) for line_no, line in lines
+             if line and not line.startswith('#')]
+    palette = batch_palette(options, lines, maps)
+    for line_no, line in lines:
+        start = time.time()
+        job_options = None
+        try:
+            job_options = batch_job_options(options, json.loads(line))
+            if palette and job_options.palette == options.palette:
+                job_options.palette = palette
+            open_job_files(job_options)
+            run(job_options, maps)
+            succeeded.append(line_no)
+            logging.info('Job %s: %s done in %.2f s', line_no, job_options.output,
+                         time.time() - start)
+        except Exception as e:
+            failed.append(line_no)
+            logging.error('Job %s failed: %s', line_no, e)
+        finally:
+            if job_options:
+                for f in (job_options.wld, job_options.ozi):
+                    if f and not isinstance(f, str):
+                        f.close()
+    logging.info('Batch finished: %s jobs succeeded, %s failed%s', len(succeeded), len(failed),
+                 ' (lines {})'.format(', '.join(str(n) for n in failed)) if failed else '')
+    return not failed
+
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg',
+    'webp': 'image/webp',
+    'tiff': 'image/tiff',
+    'tif': 'image/tiff',
+    'cog': 'image/tiff',
+    'svg': 'image/svg+xml',
+    'pdf': 'application/pdf',
+}
+
+
+def request_options(style, params):
+    """Make render options from style path and a dict of HTTP query parameters"""
+    def floats(name, count):
+        value = [float(v) for v in params[name].replace('x', ',').split(',')]
+        if len(value) != count:
+            raise Exception('Parameter {} needs {} numbers'.format(name, count))
+        return value
+
+    options = create_parser().parse_args([style, '-'])
+    options.fmt = params.get('format', 'png256')
+    if 'bbox' in params:
+        options.bbox = floats('bbox', 4)
+    if 'center' in params:
+        options.center = floats('center', 2)
+    if 'size' in params:
+        options.size_px = [int(v) for v in floats('size', 2)]
+    for name in ('zoom', 'scale', 'factor', 'ppi'):
+        if name in params:
+            setattr(options, name, float(params[name]))
+    for name in ('layers', 'add_layers', 'hide_layers', 'fit', 'projection', 'paper'):
+        if name in params:
+            setattr(options, name, params[name])
+    if 'vars' in params:
+        options.vars = params['vars'].split(';')
+    options.norotate = True
+    parse_tiles(options)
+    return options
+
+
+# Loaded maps and style files of a render service process, see init_serve_worker()
+_serve_maps = None
+_serve_styles = None
+
+
+def init_serve_worker(styles, fonts):
+    """Register fonts and preload all styles in a render service process"""
+    global _serve_maps, _serve_styles
+    if fonts:
+        for f in fonts:
+            add_fonts(f)
+    # room for preloaded styles and a few variants requested with other options
+    _serve_maps = MapCache(MAP_CACHE_SIZE + len(styles))
+    _serve_styles = styles
+    for path in styles.values():
+        options = request_options(path, {})
+        load_style(options, get_projection(options.projection), _serve_maps)
+
+
+class RequestError(Exception):
+    """Wrong parameters of a render service request, answered with 400"""
+
+
+def render_request_task(params):
+    """Render a map for the render service. Returns (format, data)"""
+    style = params.get('style')
+    if style is None:
+        style = sorted(_serve_styles)[0]
+    if style not in _serve_styles:
+        raise RequestError('Unknown style: {}'.format(style))
+    try:
+        options = request_options(_serve_styles[style], params)
+    except Exception as e:
+        raise RequestError(str(e))
+    stream = io.BytesIO()
+    run(options, _serve_maps, stream)
+    return options.fmt, stream.getvalue()
+
+
+def serve(args):
+    """Run a local HTTP render service: nik4.py serve [options] style..."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qsl
+
+    parser = argparse.ArgumentParser(
+        prog='nik4.py serve',
+        description='Nik4 {}: HTTP map rendering service'.format(VERSION))
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Number of render processes (default = number of CPUs)')
+    parser.add_argument('--fonts', nargs='*',
+                        help='List of full path to directories containing fonts')
+    parser.add_argument('-v', '--debug', action='store_true', default=False,
+                        help='Log every request')
+    parser.add_argument('styles', nargs='+', metavar='style',
+                        help='Style file for mapnik, as path or name=path')
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+
+    styles = {}
+    for style in options.styles:
+        if '=' in style:
+            name, path = style.split('=', 1)
+        else:
+            path = style
+            name = os.path.splitext(os.path.basename(style))[0]
+        styles[name] = path
+
+    pool = multiprocessing.Pool(options.jobs or None, initializer=init_serve_worker,
+                                initargs=(styles, options.fonts))
+
+    class RenderHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = dict(parse_qsl(urlparse(self.path).query))
+            try:
+                fmt, data = pool.apply(render_request_task, (params,))
+            except RequestError as e:
+                # the reason phrase stays fixed, the message goes only into the escaped body
+                self.send_error(400, explain=re.sub(r'[\r\n]+', ' ', str(e)))
+                return
+            except Exception as e:
+                logging.error('Failed to render %s: %s', self.path, e)
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES.get(
+                re.match(r'[a-z]*', fmt).group(0), 'application/octet-stream'))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug('%s %s', self.address_string(), format % args)
+
+    server = ThreadingHTTPServer((options.host, options.port), RenderHandler)
+    logging.info('Serving styles %s on http://%s:%s/', ', '.join(sorted(styles)),
+                 options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+
+
+def create_parser():
+    """Make the command-line argument parser"""
     parser = argparse.ArgumentParser(
         description='Nik4 {}: Tile-aware mapnik image renderer'.format(VERSION))
     parser.add_argument('--version', action='version', version='Nik4 {}'.format(VERSION))
@@ -633,14 +3252,59 @@ if __name__ == "__main__":
     parser.add_argument('--ozi', type=argparse.FileType('w'), help='Generate ozi map file')
     parser.add_argument('--wld', type=argparse.FileType('w'), help='Generate world file')
     parser.add_argument('-t', '--tiles', default='1',
-                        help='Write N×N (--tiles N) or N×M (--tiles NxM) tiles, '
-                        'then join using imagemagick')
+                        help='Render N×N (--tiles N) or N×M (--tiles NxM) tiles, '
+                        'then join them; "auto" chooses tiles by size, memory and --jobs')
+    parser.add_argument('--max-memory', type=parse_bytes,
+                        help='Memory limit for --tiles auto, e.g. 4G (default: half of free '
+                        'memory)')
     parser.add_argument('--just-tiles', action='store_true', default=False,
                         help='Do not join tiles, instead write ozi/wld file for each')
+    parser.add_argument('--skip-empty', action='store_true', default=False,
+                        help='Do not render layers in tiles outside their extent')
+    parser.add_argument('--skip-empty-mode', choices=['extent', 'features'], default='extent',
+                        help='Compare tiles with layer extents or with bounding boxes of '
+                        'their features for --skip-empty (default=extent)')
+    parser.add_argument('--strips', action='store_true', default=False,
+                        help='Write joined tiles to a 32-bit PNG row by row, keeping only '
+                        'one row of tiles in memory')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes for rendering tiles (0 = number of CPUs)')
+    parser.add_argument('--cache-dir',
+                        help='Directory for caching rendered images')
+    parser.add_argument('--cache-max-bytes', type=int, default=1024**3,
+                        help='Maximum size of the cache (default=1 GB)')
+    parser.add_argument('--pyramid', type=parse_pyramid, metavar='ZOOMS',
+                        help='Render web mercator tiles for zoom levels (e.g. 10-14) into '
+                        'a .mbtiles file or a z/x/y directory')
+    parser.add_argument('--metatile', type=positive_int, default=8,
+                        help='Render --pyramid tiles in blocks of N×N tiles (default=8)')
+    parser.add_argument('--atlas', action='store_true', default=False,
+                        help='Split the area into pages of --paper size at the given zoom '
+                        'or scale and render them into a multi-page PDF')
+    parser.add_argument('--overlap', type=float, default=10,
+                        help='Overlap of --atlas pages in mm (default=10)')
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help='Render K-th of N parts of the --tiles grid into a directory, '
+                        'to be joined with "nik4.py merge"')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Keep running and render tiles again when the style or data '
+                        'files change')
+    parser.add_argument('--watch-interval', type=float, default=1.0, metavar='SECONDS',
+                        help='Check files for --watch every N seconds (default=1)')
+    parser.add_argument('--profile-layers', action='store_true', default=False,
+                        help='Instead of saving an image, print render time of each layer')
+    parser.add_argument('--profile-layers-mode', choices=['alone', 'without'], default='alone',
+                        help='Render each layer alone or the map without it for '
+                        '--profile-layers (default=alone)')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='Write time and memory spent on each phase and tile to a JSON file')
     parser.add_argument('-v', '--debug', action='store_true', default=False,
                         help='Display calculated values')
     parser.add_argument('-f', '--format', dest='fmt',
                         help='Target file format (by default looks at extension)')
+    parser.add_argument('--palette', metavar='FILE',
+                        help='Quantize PNG images and tiles to one palette: from a paletted PNG, '
+                        'an .act or an RGB file, or "auto" to sample it from the map')
     parser.add_argument('--base',
                         help='Base path for style file, in case it\'s piped to stdin')
     parser.add_argument('--vars', nargs='*',
@@ -648,29 +3312,50 @@ if __name__ == "__main__":
                         'style file (use ${name:default})')
     parser.add_argument('--fonts', nargs='*',
                         help='List of full path to directories containing fonts')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help='Render jobs from a JSON lines file, one set of options per line')
     parser.add_argument('style', help='Style file for mapnik')
-    parser.add_argument('output', help='Resulting image file')
-    options = parser.parse_args()
+    parser.add_argument('output', nargs='?', help='Resulting image file')
+    parser.add_argument('outputs', nargs='*', metavar='output',
+                        help='More files for the same map in other formats; '
+                        'name@2x.png doubles --factor and size')
+    return parser
 
-    options.tiles_x = 0
-    options.tiles_y = 0
 
-    if options.tiles:
-        if options.tiles.isdigit():
-            options.tiles_x = int(options.tiles)
-            options.tiles_y = options.tiles_x
-        else:
-            match = re.search(r'^(\d+)x(\d+)$', options.tiles)
-            if match:
-                options.tiles_x = int(match.group(1))
-                options.tiles_y = int(match.group(2))
-        if not 1 <= options.tiles_x * options.tiles_y <= 144:
-            raise Exception('--tiles needs positive integer argument, or two integers separated '
-                            'by x; max. number of tiles is 144')
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge(sys.argv[2:])
+        sys.exit(0)
+
+    parser = create_parser()
+    # options can go between the style and output files, like before
+    # additional outputs were added
+    options = parser.parse_intermixed_args()
+
+    if not options.batch and not options.output and not options.profile_layers:
+        parser.error('the following arguments are required: output')
+    parse_tiles(options)
 
     if options.debug:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
     logging.basicConfig(level=log_level, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
-    run(options)
+    if options.batch:
+        if not run_batch(options):
+            sys.exit(1)
+    elif options.pyramid:
+        run_pyramid(options)
+    elif options.atlas:
+        run_atlas(options)
+    elif options.watch:
+        run_watch(options)
+    elif options.shard:
+        run_shard(options)
+    elif options.outputs:
+        run_outputs(options)
+    else:
+        run(options)
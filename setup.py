@@ -22,6 +22,7 @@ to see available options and their descriptions.
         requires=['Mapnik'],
         keywords='Mapnik,GIS,OpenStreetMap,mapping,export',
         scripts=['nik4.py'],
+        py_modules=['nik4'],
         packages=[],
         classifiers=[
             'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,135 @@
+import io
+import os
+import struct
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nik4  # noqa: E402
+
+try:
+    import mapnik
+except ImportError:
+    mapnik = None
+
+TILE = 256
+TYPE_SIZES = {2: 1, 3: 2, 4: 4, 12: 8, 16: 8}
+
+
+def read_ifds(data):
+    """Parse a little-endian classic tiff into a list of (offset, {tag: values})"""
+    order, magic, offset = struct.unpack_from('<2sHI', data, 0)
+    assert order == b'II' and magic == 42
+    ifds = []
+    while offset:
+        count = struct.unpack_from('<H', data, offset)[0]
+        tags = {}
+        for i in range(count):
+            tag, typ, n = struct.unpack_from('<HHI', data, offset + 2 + i * 12)
+            size = TYPE_SIZES[typ] * n
+            pos = offset + 2 + i * 12 + 8
+            if size > 4:
+                pos = struct.unpack_from('<I', data, pos)[0]
+            raw = data[pos:pos + size]
+            if typ == 2:
+                tags[tag] = raw.rstrip(b'\0').decode('ascii')
+            else:
+                tags[tag] = list(struct.unpack('<{}{}'.format(n, nik4.TIFF_TYPES[typ]), raw))
+        ifds.append((offset, tags))
+        offset = struct.unpack_from('<I', data, offset + 2 + count * 12)[0]
+    return ifds
+
+
+@unittest.skipIf(mapnik is None, 'needs mapnik')
+class GeoTIFFWriterTest(unittest.TestCase):
+    size = (700, 300)
+    colors = [(200, 10, 20, 255), (30, 40, 250, 128)]
+
+    def write(self, projection):
+        bbox = mapnik.Box2d(1000, 2000, 8000, 5000)
+        levels = [self.size, (350, 150)]
+        out = io.BytesIO()
+        tags = nik4.geotiff_tags(bbox, self.size, nik4.get_projection(projection), projection)
+        writer = nik4.GeoTIFFWriter(out, levels, tags, tile_size=TILE)
+
+        def image(width, height, color):
+            im = mapnik.Image(width, height)
+            im.fill(mapnik.Color(*color))
+            return im
+
+        # overview first, like write_geotiff() does, then the image in two parts
+        writer.add_tile(1, 0, 0, image(350, 150, self.colors[1]))
+        writer.add_tile(0, 0, 0, image(512, 300, self.colors[0]))
+        writer.add_tile(0, 512, 0, image(188, 300, self.colors[0]))
+        writer.close()
+        return bbox, out.getvalue()
+
+    def check_tiles(self, data, tags, size, color):
+        across = [-(-d // TILE) for d in size]
+        offsets, counts = tags[324], tags[325]
+        self.assertEqual(len(offsets), across[0] * across[1])
+        self.assertEqual(len(counts), len(offsets))
+        pixel = bytes(bytearray(color))
+        for index, (offset, count) in enumerate(zip(offsets, counts)):
+            self.assertGreater(offset, 0)
+            self.assertLessEqual(offset + count, len(data))
+            d = zlib.decompressobj()
+            tile = d.decompress(data[offset:offset + count])
+            # the byte count covers exactly one deflate stream
+            self.assertTrue(d.eof)
+            self.assertEqual(d.unused_data, b'')
+            self.assertEqual(len(tile), TILE * TILE * 4)
+            ty, tx = divmod(index, across[0])
+            width = min(TILE, size[0] - tx * TILE)
+            height = min(TILE, size[1] - ty * TILE)
+            row = pixel * width + b'\0' * ((TILE - width) * 4)
+            for y in range(TILE):
+                expected = row if y < height else b'\0' * (TILE * 4)
+                self.assertEqual(tile[y * TILE * 4:(y + 1) * TILE * 4], expected)
+
+    def test_structure(self):
+        bbox, data = self.write(nik4.EPSG_3857)
+        ifds = read_ifds(data)
+        self.assertEqual(len(ifds), 2)
+        (main_offset, main), (overview_offset, overview) = ifds
+        # directories come before tiles, the overview right after the image
+        self.assertEqual(main_offset, 8)
+        self.assertGreater(overview_offset, main_offset)
+        self.assertLess(overview_offset, min(main[324] + overview[324]))
+        self.assertEqual((main[256][0], main[257][0]), self.size)
+        self.assertEqual((overview[256][0], overview[257][0]), (350, 150))
+        self.assertEqual(main[254], [0])
+        self.assertEqual(overview[254], [1])
+        for tags in (main, overview):
+            self.assertEqual(tags[258], [8, 8, 8, 8])
+            self.assertEqual(tags[259], [8])
+            self.assertEqual(tags[322], [TILE])
+            self.assertEqual(tags[323], [TILE])
+            self.assertEqual(tags[338], [2])
+        self.check_tiles(data, main, self.size, self.colors[0])
+        self.check_tiles(data, overview, (350, 150), self.colors[1])
+        # geo tags are written only for the image
+        self.assertNotIn(33922, overview)
+        self.assertEqual(main[33922], [0, 0, 0, bbox.minx, bbox.maxy, 0])
+        self.assertEqual(main[33550], [10.0, 10.0, 0.0])
+        self.assertEqual(main[34735][:4], [1, 1, 0, 4])
+        keys = dict((main[34735][i], main[34735][i + 1:i + 4])
+                    for i in range(4, len(main[34735]), 4))
+        self.assertEqual(keys[1024], [0, 1, 1])  # projected
+        self.assertEqual(keys[1025], [0, 1, 1])
+        self.assertEqual(keys[3072], [0, 1, 3857])
+        self.assertEqual(keys[1026], [34737, len(main[34737]), 0])
+        self.assertTrue(main[34737].endswith('|'))
+
+    def test_geographic(self):
+        _, data = self.write('epsg:4326')
+        main = read_ifds(data)[0][1]
+        keys = dict((main[34735][i], main[34735][i + 1:i + 4])
+                    for i in range(4, len(main[34735]), 4))
+        self.assertEqual(keys[1024], [0, 1, 2])
+        self.assertEqual(keys[2048], [0, 1, 4326])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nik4  # noqa: E402
+
+try:
+    import mapnik  # noqa: F401
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'needs mapnik and numpy')
+class PlanBatchTest(unittest.TestCase):
+    """plan_batch() should give the same results as plan_map() through plan_batch_scalar()"""
+
+    def compare(self, projection, **kwargs):
+        count = len(kwargs.get('centers', kwargs.get('bboxes')))
+        arrays = {}
+        for key, width in (('sizes', 2), ('zooms', None), ('scales', None),
+                           ('centers', 2), ('bboxes', 4)):
+            value = kwargs.get(key)
+            if value is not None:
+                shape = (count,) if width is None else (count, width)
+                value = numpy.broadcast_to(numpy.asarray(value, dtype=float), shape)
+            arrays[key] = value
+        bbox, scale, size = nik4.plan_batch(projection=projection, **kwargs)
+        expected = nik4.plan_batch_scalar(count, arrays['sizes'], arrays['zooms'],
+                                          arrays['scales'], arrays['centers'], arrays['bboxes'],
+                                          1, projection, False)
+        numpy.testing.assert_allclose(bbox, expected[0], rtol=1e-9)
+        numpy.testing.assert_allclose(scale, expected[1], rtol=1e-9)
+        numpy.testing.assert_array_equal(size, expected[2])
+
+    def test_zooms_with_centers(self):
+        for projection in (nik4.EPSG_3857, nik4.EPSG_4326):
+            self.compare(projection, centers=[[24.75, 59.43], [0, 0], [-70, -30]],
+                         zooms=[0, 5, 14], sizes=[256, 256])
+
+    def test_zooms_with_bboxes(self):
+        for projection in (nik4.EPSG_3857, nik4.EPSG_4326):
+            self.compare(projection, bboxes=[[24.6, 59.35, 24.9, 59.5], [-10, -10, 10, 10]],
+                         zooms=[0, 12])
+
+    def test_scales(self):
+        self.compare(nik4.EPSG_3857, centers=[[24.75, 59.43], [10, 50]], scales=[5000, 100000],
+                     sizes=[[400, 300], [300, 400]])
+
+    def test_zoom_zero_is_a_zoom(self):
+        _, scale, _ = nik4.plan_batch(centers=[[0, 0]], zooms=[0], sizes=[256, 256])
+        self.assertAlmostEqual(scale[0], 2 * 3.14159 * 6378137 / 256)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import nik4  # noqa: E402
+
+
+STYLE = '''<Map>
+  <!-- ${comment:default comment} -->
+  <Layer name="base" status="off" srs="${srs:epsg:3857}">
+    <StyleName>base</StyleName>
+  </Layer>
+  <Layer status='off' name='labels'>
+    <Layer name="inner">
+      <StyleName>inner</StyleName>
+    </Layer>
+  </Layer>
+  <Layer name="route" srs="epsg:4326" />
+  <Layer name="roads">
+    <Datasource>
+      <Parameter name="file">${roads:roads.shp}</Parameter>
+    </Datasource>
+  </Layer>
+</Map>
+'''
+
+
+def layer_names(style):
+    return [nik4.LAYER_NAME.search(tag).group(2) for tag in re.findall(r'<Layer\b[^>]*>', style)]
+
+
+class PreprocessStyleTest(unittest.TestCase):
+    def test_unchanged(self):
+        self.assertEqual(nik4.preprocess_style(STYLE), STYLE)
+
+    def test_reenable_layers(self):
+        style = nik4.preprocess_style(STYLE, enable=['base', 'labels'])
+        self.assertIn('<Layer name="base" srs="${srs:epsg:3857}">', style)
+        self.assertIn("<Layer name='labels'>", style)
+        style = nik4.preprocess_style(STYLE, enable=['labels'])
+        self.assertIn('<Layer name="base" status="off"', style)
+
+    def test_variables(self):
+        style = nik4.preprocess_style(STYLE, ['roads=a&b.shp', 'comment=x'])
+        self.assertIn('<Parameter name="file">a&amp;b.shp</Parameter>', style)
+        self.assertIn('srs="epsg:3857"', style)
+        self.assertIn('<!-- x -->', style)
+        self.assertNotIn('${', style)
+
+    def test_variables_in_comments(self):
+        style = nik4.preprocess_style(STYLE, ['roads=r.shp'])
+        self.assertIn('<!-- default comment -->', style)
+
+    def test_required_variable(self):
+        style = '<Map><!-- ${needed} --></Map>'
+        self.assertEqual(nik4.preprocess_style(style), style)
+        with self.assertRaises(Exception):
+            nik4.preprocess_style(style, ['other=1'])
+
+    def test_required_variable_in_removed_layer(self):
+        style = '<Map><Layer name="a"><Parameter>${needed}</Parameter></Layer></Map>'
+        keep = nik4.layer_keeper([], [], ['a'], [])
+        with self.assertRaises(Exception):
+            nik4.preprocess_style(style, ['other=1'], keep=keep)
+
+    def test_remove_nested_layers(self):
+        keep = nik4.layer_keeper(['base', 'route', 'inner'], [], [], [])
+        style = nik4.preprocess_style(STYLE, keep=keep)
+        # inner is dropped together with its parent
+        self.assertEqual(layer_names(style), ['base', 'route'])
+        self.assertTrue(style.endswith('</Map>\n'))
+        self.assertEqual(style.count('<Layer'), style.count('</Layer>') + 1)
+
+    def test_remove_self_closing_layer(self):
+        keep = nik4.layer_keeper([], [], ['route'], [])
+        style = nik4.preprocess_style(STYLE, keep=keep)
+        self.assertEqual(layer_names(style), ['base', 'labels', 'inner', 'roads'])
+        self.assertEqual(style.count('<Layer'), style.count('</Layer>'))
+
+    def test_keep_fit_layers(self):
+        keep = nik4.layer_keeper([], [], ['route', 'roads'], ['roads'])
+        style = nik4.preprocess_style(STYLE, keep=keep)
+        self.assertEqual(layer_names(style), ['base', 'labels', 'inner', 'roads'])
+        keep = nik4.layer_keeper(['base'], [], [], ['route'])
+        style = nik4.preprocess_style(STYLE, keep=keep)
+        self.assertEqual(layer_names(style), ['base', 'route'])
+
+    def test_add_layers(self):
+        keep = nik4.layer_keeper(['base'], ['labels'], [], [])
+        style = nik4.preprocess_style(STYLE, enable=['base', 'labels'], keep=keep)
+        # inner is not listed, but is kept with its parent
+        self.assertEqual(layer_names(style), ['base', 'labels', 'inner'])
+        self.assertNotIn('status', style)
+
+    def test_keep_all(self):
+        self.assertIsNone(nik4.layer_keeper([], ['x'], [], ['y']))
+
+
+if __name__ == '__main__':
+    unittest.main()